@@ -1,6 +1,9 @@
 # app.py
 # --- The main web application file (with Authentication and Branding) ---
 
+# --- NEW: Imported first so startup timing covers the imports below ---
+from warmup import run_warmup_hooks, report_startup, record_first_request
+
 import os
 import shutil
 import zipfile
@@ -9,16 +12,21 @@ import xml.etree.ElementTree as ET
 import fnmatch
 import logging
 import time
+import math
 import io
 import json
+import uuid
+import base64
+import multiprocessing
 from functools import wraps
-from urllib.request import urlopen
 
-# --- NEW: Import Pillow for image processing ---
-from PIL import Image
-from flask import Flask, request, send_from_directory, jsonify, Response, after_this_request, send_file
+# --- MODIFIED: Pillow is imported lazily (see handle_branding) ---
+from flask import Flask, Blueprint, request, send_from_directory, jsonify, Response, after_this_request, send_file, current_app, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file as send_file_for_environ
+from werkzeug.http import is_resource_modified
 from jose import jwt
 
 # --- NEW: Import Flask-Limiter for rate limiting ---
@@ -28,56 +36,82 @@ from flask_limiter.util import get_remote_address
 # --- NEW: Import and set up logging ---
 from logging_config import setup_logging
 
-# --- REVISED: Auth0 Configuration from Environment Variables ---
-AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
-API_AUDIENCE = os.environ.get('API_AUDIENCE')
-ALGORITHMS = ["RS256"]
+# --- NEW: Shared blob store and archive writer for engine runtime files ---
+from blob_store import BlobStore, CHUNK_SIZE
+from archive_writer import ArchiveWriter, list_archive_entries, tree_size, write_digest_sidecar, read_digest_sidecar, DIGEST_SUFFIX
+
+# --- NEW: Operator-only per-job profiling ---
+from job_profiler import profile_stream, PROFILE_ARTIFACTS
+
+# --- NEW: Structured SSE progress protocol ---
+from progress import ProgressEncoder, ProgressUpdate, ProgressEvent
+
+# --- NEW: Durable per-job journal for resumable jobs ---
+from job_journal import JobJournal, prune_journals
+
+# --- NEW: Deep validation of manifest references ---
+from manifest_validator import validate_manifest
+
+# --- NEW: Cached signing keys ---
+from jwks_cache import JWKSCache
+
+# --- NEW: Fair-share scheduling of jobs across users ---
+from scheduler import FairShareScheduler
+
+# --- NEW: Resource-budgeted admission with adaptive limits ---
+from concurrency_controller import AdaptiveScheduler, predict_job_resources, predict_upload_resources, memory_limit_bytes, available_cores
 
-# Validate that the environment variables are set
-if not all([AUTH0_DOMAIN, API_AUDIENCE]):
-    raise RuntimeError("Missing required Auth0 environment variables (AUTH0_DOMAIN, API_AUDIENCE).")
+# --- NEW: Historical job metrics ---
+from job_analytics import JobAnalytics, JobMemoryTracker, parse_duration
+
+# --- NEW: Processing packages while they upload ---
+from stream_pipeline import PipelinedUpload, NotStreamable, iter_stream_package, verify_central_directory
+
+ALGORITHMS = ["RS256"]
 
 # --- NEW: Branding Configuration ---
 LOGO_WIDTH = 300
 LOGO_HEIGHT = 88
 LOGO_FILENAME_IENGINE5 = "customer_logo.png"
 
-# --- Flask App Initialization ---
-app = Flask(__name__)
-CORS(app)
+# --- NEW: Transformation rules, compiled once at import (in the gunicorn master when preloading) ---
+CLEANUP_FILE_PATTERNS = ['aicc.*', 'readme.md', '.gitignore', 'README.md']
+CLEANUP_FILE_RE = re.compile('|'.join(fnmatch.translate(p) for p in CLEANUP_FILE_PATTERNS))
+CLEANUP_DIRS = frozenset(['.idea', '.vscode', '__MACOSX'])
+# --- NEW: Files the steps may rewrite or replace; a pipelined upload extracts these instead of copying them ---
+PIPELINE_REWRITE_TARGETS = frozenset([
+    'imsmanifest.xml', 'imsmanifest_SCORM2004.xml', 'js/data.xml', 'js/scorm_2004.js',
+    'js/course-engine-txt.js', 'js/course-engine-video.js', 'skins/black-unique/skinimages/' + LOGO_FILENAME_IENGINE5,
+])
+ET.register_namespace('', "http://www.w3.org/2001/XMLSchema")
 
-# --- NEW: Initialize the rate limiter ---
+# --- MODIFIED: Routes live on a blueprint; the app itself is built by create_app() ---
+api = Blueprint('api', __name__)
+
+# --- NEW: Initialize the rate limiter (bound to the app in create_app) ---
+# --- MODIFIED: Limits are named so the ASGI front-end can apply the same ones ---
+DEFAULT_RATE_LIMITS = ["200 per day", "50 per hour"]
+PROCESS_RATE_LIMIT = "20 per minute"
 limiter = Limiter(
     get_remote_address,
-    app=app,
-    default_limits=["200 per day", "50 per hour"],
+    default_limits=DEFAULT_RATE_LIMITS,
     storage_uri="memory://",
 )
 
-# --- NEW: Setup logging from the external file ---
-setup_logging(app)
-
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['PROCESSED_FOLDER'] = 'processed'
-app.config['KNOWBE4_FILE_PATH'] = 'special_files/scorm_2004.js'
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
 
-
-# --- Authentication Decorator (Unchanged) ---
+# --- Authentication Decorator ---
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
         self.status_code = status_code
 
-@app.errorhandler(AuthError)
+@api.app_errorhandler(AuthError)
 def handle_auth_error(ex):
     response = jsonify(ex.error)
     response.status_code = ex.status_code
     return response
 
-def get_token_auth_header():
-    auth = request.headers.get("Authorization", None)
+def get_token_auth_header(auth):
     if not auth:
         raise AuthError({"code": "authorization_header_missing", "description": "Authorization header is expected"}, 401)
     parts = auth.split()
@@ -90,32 +124,84 @@ def get_token_auth_header():
     token = parts[1]
     return token
 
+# --- NEW: Scope checks for operator-only features ---
+def has_scope(jwt_payload, required_scope):
+    """Checks both the OAuth `scope` string and Auth0 RBAC `permissions`."""
+    scopes = set((jwt_payload.get('scope') or '').split())
+    scopes.update(jwt_payload.get('permissions') or [])
+    return required_scope in scopes
+
+def requires_profiling_scope(jwt_payload):
+    if not has_scope(jwt_payload, current_app.config['PROFILING_SCOPE']):
+        raise AuthError({"code": "insufficient_scope", "description": "Profiling requires the operator scope"}, 403)
+
+def requires_priority_scope(jwt_payload):
+    if not has_scope(jwt_payload, current_app.config['SCHEDULER_PRIORITY_SCOPE']):
+        raise AuthError({"code": "insufficient_scope", "description": "The priority lane requires the priority scope"}, 403)
+
+def requires_analytics_scope(jwt_payload):
+    if not has_scope(jwt_payload, current_app.config['ANALYTICS_SCOPE']):
+        raise AuthError({"code": "insufficient_scope", "description": "Job analytics require the analytics scope"}, 403)
+
+# --- MODIFIED: Token checks take the raw header so the ASGI front-end can share them ---
+def decode_auth_header(auth):
+    """Validates an `Authorization: Bearer` header value and returns the JWT payload, or raises AuthError."""
+    token = get_token_auth_header(auth)
+    unverified_header = jwt.get_unverified_header(token)
+    # --- MODIFIED: Signing keys come from the shared JWKS cache, not a fetch per request ---
+    key = current_app.extensions['jwks'].get_key(unverified_header["kid"])
+    rsa_key = {}
+    if key is not None:
+        rsa_key = { "kty": key["kty"], "kid": key["kid"], "use": key["use"], "n": key["n"], "e": key["e"] }
+    if rsa_key:
+        try:
+            return jwt.decode( token, rsa_key, algorithms=ALGORITHMS, audience=current_app.config['API_AUDIENCE'], issuer=f"https://{current_app.config['AUTH0_DOMAIN']}/" )
+        except jwt.ExpiredSignatureError:
+            raise AuthError({"code": "token_expired", "description": "token is expired"}, 401)
+        except jwt.JWTClaimsError:
+            raise AuthError({"code": "invalid_claims", "description": "incorrect claims, please check the audience and issuer"}, 401)
+        except Exception:
+            raise AuthError({"code": "invalid_header", "description": "Unable to parse authentication token."}, 400)
+    raise AuthError({"code": "invalid_header", "description": "Unable to find appropriate key"}, 400)
+
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = get_token_auth_header()
-        jsonurl = urlopen(f"https://{AUTH0_DOMAIN}/.well-known/jwks.json")
-        jwks = json.loads(jsonurl.read())
-        unverified_header = jwt.get_unverified_header(token)
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = { "kty": key["kty"], "kid": key["kid"], "use": key["use"], "n": key["n"], "e": key["e"] }
-        if rsa_key:
-            try:
-                payload = jwt.decode( token, rsa_key, algorithms=ALGORITHMS, audience=API_AUDIENCE, issuer=f"https://{AUTH0_DOMAIN}/" )
-            except jwt.ExpiredSignatureError:
-                raise AuthError({"code": "token_expired", "description": "token is expired"}, 401)
-            except jwt.JWTClaimsError:
-                raise AuthError({"code": "invalid_claims", "description": "incorrect claims, please check the audience and issuer"}, 401)
-            except Exception:
-                raise AuthError({"code": "invalid_header", "description": "Unable to parse authentication token."}, 400)
-            return f(payload, *args, **kwargs)
-        raise AuthError({"code": "invalid_header", "description": "Unable to find appropriate key"}, 400)
+        payload = decode_auth_header(request.headers.get("Authorization", None))
+        return f(payload, *args, **kwargs)
     return decorated
 
 
+# --- NEW: Static assets preloaded at startup ---
+def load_static_asset(path):
+    """Returns the bytes of a file under special_files/, from the warm-up cache when possible."""
+    cached = current_app.extensions.get('static_assets', {}).get(os.path.normpath(path))
+    if cached is not None:
+        return cached
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
 # --- Generator-based helper functions ---
+# --- NEW: Checkpointed steps rewrite the working copy, which a resumed job reads back ---
+def _write_file_atomically(file_path, data):
+    """Replaces `file_path` with `data` (str or bytes) so a killed worker leaves the old file or the new one, never part of it."""
+    tmp_path = file_path + '.tmp'
+    mode, encoding = ('wb', None) if isinstance(data, bytes) else ('w', 'utf-8')
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            f.write(data)
+            f.flush()
+            # The journal records the step as complete durably, so the edit must be on disk first.
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 def _replace_text_in_file(file_path, search_text, replace_text):
     """Helper to perform a find-and-replace on a text file."""
     try:
@@ -125,17 +211,16 @@ def _replace_text_in_file(file_path, search_text, replace_text):
         new_content = content.replace(search_text, replace_text)
         
         if content != new_content:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(new_content)
+            _write_file_atomically(file_path, new_content)
             return True
     except Exception as e:
-        app.logger.error(f"Could not replace text in {file_path}: {e}")
+        current_app.logger.error(f"Could not replace text in {file_path}: {e}")
     return False
 
 def handle_iengine5_licensing(directory, is_licensed):
     """Generator to handle licensing flag for iengine5 courses."""
     yield "[STEP] Applying iengine5 licensing settings"
-    app.logger.info(f"Setting iengine5 licensing DialogIsVisible to {is_licensed}.")
+    current_app.logger.info(f"Setting iengine5 licensing DialogIsVisible to {is_licensed}.")
     
     js_folder = os.path.join(directory, 'js')
     files_to_edit = ['course-engine-txt.js', 'course-engine-video.js']
@@ -168,46 +253,61 @@ def handle_iengine5_licensing(directory, is_licensed):
 
 def clean_unnecessary_files(directory):
     yield "[STEP] Cleaning unnecessary files and folders"
-    app.logger.info("Starting file cleanup process.")
-    files_to_remove = ['aicc.*', 'readme.md', '.gitignore', 'README.md']
-    dirs_to_remove = ['.idea', '.vscode', '__MACOSX']
+    current_app.logger.info("Starting file cleanup process.")
     found_any = False
     for root, dirs, files in os.walk(directory, topdown=False):
-        for pattern in files_to_remove:
-            for filename in fnmatch.filter(files, pattern):
+        for filename in files:
+            if CLEANUP_FILE_RE.match(filename):
                 found_any = True; file_path = os.path.join(root, filename)
                 try:
                     os.remove(file_path)
                     log_msg = f"Removed file: {os.path.relpath(file_path, directory)}"
                     yield f"  -> {log_msg}"
-                    app.logger.info(log_msg)
+                    current_app.logger.info(log_msg)
                 except OSError as e:
                     log_msg = f"Error removing file {os.path.relpath(file_path, directory)}: {e}"
                     yield f"  -> [ERROR] {log_msg}"
-                    app.logger.error(log_msg)
+                    current_app.logger.error(log_msg)
         for dirname in list(dirs):
-            if dirname in dirs_to_remove:
+            if dirname in CLEANUP_DIRS:
                 found_any = True; dir_path = os.path.join(root, dirname)
                 try:
                     shutil.rmtree(dir_path)
                     log_msg = f"Removed directory: {os.path.relpath(dir_path, directory)}"
                     yield f"  -> {log_msg}"
-                    app.logger.info(log_msg)
+                    current_app.logger.info(log_msg)
                     dirs.remove(dirname)
                 except OSError as e:
                     log_msg = f"Error removing directory {os.path.relpath(dir_path, directory)}: {e}"
                     yield f"  -> [ERROR] {log_msg}"
-                    app.logger.error(log_msg)
+                    current_app.logger.error(log_msg)
     if not found_any:
         yield "  -> No unnecessary files or folders found to clean."
-        app.logger.info("No unnecessary files found to clean.")
+        current_app.logger.info("No unnecessary files found to clean.")
     yield "     ✅ SUCCESS: Cleanup complete."
-    app.logger.info("File cleanup process completed.")
+    current_app.logger.info("File cleanup process completed.")
+
+
+def pipeline_removed_path(arcname):
+    """The file or directory (with a trailing '/') clean_unnecessary_files would delete along with `arcname`, or None."""
+    parts = arcname.rstrip('/').split('/')
+    for i, part in enumerate(parts if arcname.endswith('/') else parts[:-1]):
+        if part in CLEANUP_DIRS:
+            return '/'.join(parts[:i + 1]) + '/'
+    if not arcname.endswith('/') and CLEANUP_FILE_RE.match(parts[-1]):
+        return arcname
+    return None
+
+
+def is_pipeline_rewrite_target(arcname, logo_filename=None):
+    return (arcname in PIPELINE_REWRITE_TARGETS
+            or os.path.basename(arcname) == 'adminsettings.xml'
+            or (logo_filename is not None and arcname == f"xmls/{logo_filename}"))
 
 
 def edit_admin_settings(directory, scorm_version, engine_type, is_licensed, is_scorm_enabled, logo_details=None, license_key=None):
     yield f"[STEP] Finding and editing 'adminsettings.xml' files"
-    app.logger.info(f"Editing adminsettings.xml: SCORM Enabled={is_scorm_enabled}, Licensed={is_licensed}.")
+    current_app.logger.info(f"Editing adminsettings.xml: SCORM Enabled={is_scorm_enabled}, Licensed={is_licensed}.")
     found_files = []
     for root, _, files in os.walk(directory):
         if 'adminsettings.xml' in files:
@@ -215,9 +315,8 @@ def edit_admin_settings(directory, scorm_version, engine_type, is_licensed, is_s
             found_files.append(xml_path)
             relative_path = os.path.relpath(xml_path, directory)
             yield f"  -> Found '{relative_path}'. Applying changes..."
-            app.logger.info(f"Processing adminsettings.xml at: {relative_path}")
+            current_app.logger.info(f"Processing adminsettings.xml at: {relative_path}")
             try:
-                ET.register_namespace('', "http://www.w3.org/2001/XMLSchema")
                 tree = ET.parse(xml_path)
                 xml_root = tree.getroot()
                 
@@ -234,7 +333,7 @@ def edit_admin_settings(directory, scorm_version, engine_type, is_licensed, is_s
                     element = xml_root.find(f".//{{*}}{tag_name}") or xml_root.find(tag_name)
                     if element is not None:
                         element.text = value
-                        app.logger.info(f"Set <{tag_name}> to '{value}' in {relative_path}")
+                        current_app.logger.info(f"Set <{tag_name}> to '{value}' in {relative_path}")
                 
                 if logo_details:
                     path_to_set = logo_details['path']
@@ -244,7 +343,7 @@ def edit_admin_settings(directory, scorm_version, engine_type, is_licensed, is_s
                         if logo_element is not None:
                             logo_element.text = path_to_set
                             yield f"  -> Set <{tag}> to '{path_to_set}'"
-                            app.logger.info(f"Set <{tag}> to '{path_to_set}' in {relative_path}")
+                            current_app.logger.info(f"Set <{tag}> to '{path_to_set}' in {relative_path}")
 
                 if engine_type == 'iengine6':
                     # Handle iengine6 licensing toggle
@@ -252,10 +351,10 @@ def edit_admin_settings(directory, scorm_version, engine_type, is_licensed, is_s
                     if check_element is None:
                         check_element = ET.SubElement(xml_root, "EnableCheck")
                         yield f"  -> Created missing <EnableCheck> tag."
-                        app.logger.info(f"Created missing <EnableCheck> tag in {relative_path}")
+                        current_app.logger.info(f"Created missing <EnableCheck> tag in {relative_path}")
                     check_element.text = "true" if is_licensed else "false"
                     yield f"  -> Set <EnableCheck> to '{check_element.text}'."
-                    app.logger.info(f"Set <EnableCheck> to '{check_element.text}' in {relative_path}")
+                    current_app.logger.info(f"Set <EnableCheck> to '{check_element.text}' in {relative_path}")
                     
                     # Only apply license key if licensing is enabled
                     if is_licensed and license_key:
@@ -263,32 +362,33 @@ def edit_admin_settings(directory, scorm_version, engine_type, is_licensed, is_s
                         if key_element is None:
                             key_element = ET.SubElement(xml_root, "KeyCode")
                             yield f"  -> Created missing <KeyCode> tag."
-                            app.logger.info(f"Created missing <KeyCode> tag in {relative_path}")
+                            current_app.logger.info(f"Created missing <KeyCode> tag in {relative_path}")
                         key_element.text = license_key
                         yield f"  -> Set <KeyCode> with license key."
-                        app.logger.info(f"Set <KeyCode> in {relative_path}")
+                        current_app.logger.info(f"Set <KeyCode> in {relative_path}")
 
-                tree.write(xml_path, encoding='utf-8', xml_declaration=True)
+                _write_file_atomically(xml_path, ET.tostring(xml_root, encoding='utf-8', xml_declaration=True))
             except Exception as e:
                 log_msg = f"Failed to edit {relative_path}: {e}"
                 yield f"  -> [ERROR] {log_msg}"
-                app.logger.error(log_msg)
+                current_app.logger.error(log_msg)
     if not found_files:
         yield "     ⚠️ WARNING: No 'adminsettings.xml' files were found in the package."
-        app.logger.warning("No adminsettings.xml files found.")
+        current_app.logger.warning("No adminsettings.xml files found.")
     else:
         yield f"     ✅ SUCCESS: Processed {len(found_files)} 'adminsettings.xml' file(s)."
-        app.logger.info(f"Finished processing {len(found_files)} adminsettings.xml file(s).")
+        current_app.logger.info(f"Finished processing {len(found_files)} adminsettings.xml file(s).")
 
 
 def handle_branding(directory, logo_file_storage, engine_type, logo_filename):
     yield "[STEP] Processing branding logo"
-    app.logger.info("Starting branding process.")
+    current_app.logger.info("Starting branding process.")
     try:
+        from PIL import Image  # Optional dependency, only needed when a logo is uploaded
         img = Image.open(logo_file_storage)
         if img.width != LOGO_WIDTH or img.height != LOGO_HEIGHT:
             yield f"  -> Resizing logo from {img.width}x{img.height} to {LOGO_WIDTH}x{LOGO_HEIGHT}px."
-            app.logger.info(f"Resizing logo to {LOGO_WIDTH}x{LOGO_HEIGHT}px.")
+            current_app.logger.info(f"Resizing logo to {LOGO_WIDTH}x{LOGO_HEIGHT}px.")
             img = img.resize((LOGO_WIDTH, LOGO_HEIGHT), Image.Resampling.LANCZOS)
         
         logo_details = {}
@@ -305,196 +405,510 @@ def handle_branding(directory, logo_file_storage, engine_type, logo_filename):
         img.save(logo_final_path, 'PNG')
         log_msg = f"Saved logo to: {os.path.relpath(logo_final_path, directory)}"
         yield f"  -> {log_msg}"
-        app.logger.info(log_msg)
+        current_app.logger.info(log_msg)
         
         logo_details['path'] = logo_path_for_xml
         yield "     ✅ SUCCESS: Branding processed."
-        app.logger.info("Branding process completed successfully.")
+        current_app.logger.info("Branding process completed successfully.")
         return logo_details
     except Exception as e:
-        app.logger.error(f"Branding failed: {e}", exc_info=True)
+        current_app.logger.error(f"Branding failed: {e}", exc_info=True)
         raise ValueError(f"Could not process logo: {e}")
 
 
 def handle_license_key(directory, license_key):
     yield "[STEP] Applying license key for iengine5"
-    app.logger.info("Applying license key for iengine5.")
+    current_app.logger.info("Applying license key for iengine5.")
     data_xml_path = os.path.join(directory, 'js', 'data.xml')
     if not os.path.exists(data_xml_path):
-        app.logger.error("data.xml not found for iengine5.")
+        current_app.logger.error("data.xml not found for iengine5.")
         raise ValueError("'data.xml' not found in js folder for iengine5 course.")
     
     try:
-        with open(data_xml_path, 'w', encoding='utf-8') as f:
-            f.write(license_key)
+        _write_file_atomically(data_xml_path, license_key)
         yield "  -> Overwrote 'js/data.xml' with the new license key."
         yield "     ✅ SUCCESS: License key applied."
-        app.logger.info("Successfully wrote license key to js/data.xml.")
+        current_app.logger.info("Successfully wrote license key to js/data.xml.")
     except Exception as e:
-        app.logger.error(f"Failed to write license key: {e}", exc_info=True)
+        current_app.logger.error(f"Failed to write license key: {e}", exc_info=True)
         raise ValueError(f"Could not write license key to data.xml: {e}")
 
 
 def edit_js_files_2004(js_folder_path, is_knowbe4):
     yield "[STEP] Editing JavaScript files for SCORM 2004"
-    app.logger.info("Starting JS file edits for SCORM 2004.")
+    current_app.logger.info("Starting JS file edits for SCORM 2004.")
     scorm_2004_js_path = os.path.join(js_folder_path, 'scorm_2004.js')
     if is_knowbe4:
         yield "  -> KnowBe4 option selected. Replacing scorm_2004.js..."
-        app.logger.info("KnowBe4 option selected. Replacing scorm_2004.js.")
-        knowbe4_special_file = app.config['KNOWBE4_FILE_PATH']
-        if not os.path.exists(knowbe4_special_file):
+        current_app.logger.info("KnowBe4 option selected. Replacing scorm_2004.js.")
+        knowbe4_special_file = current_app.config['KNOWBE4_FILE_PATH']
+        knowbe4_content = load_static_asset(knowbe4_special_file)
+        if knowbe4_content is None:
             raise ValueError(f"Special KnowBe4 file not found on server at: {knowbe4_special_file}")
         if not os.path.exists(scorm_2004_js_path):
              raise ValueError("Cannot replace scorm_2004.js because it does not exist in the package.")
         try:
-            shutil.copyfile(knowbe4_special_file, scorm_2004_js_path)
+            _write_file_atomically(scorm_2004_js_path, knowbe4_content)
             yield "     ✅ SUCCESS: Replaced scorm_2004.js with KnowBe4 version."
-            app.logger.info("Successfully replaced scorm_2004.js with KnowBe4 version.")
+            current_app.logger.info("Successfully replaced scorm_2004.js with KnowBe4 version.")
         except Exception as e:
-            app.logger.error(f"Failed to replace scorm_2004.js: {e}", exc_info=True)
+            current_app.logger.error(f"Failed to replace scorm_2004.js: {e}", exc_info=True)
             raise ValueError(f"Could not replace scorm_2004.js: {e}")
     else:
         yield "  -> Standard processing. Replacing LMSCommit() with SCORM2004_CallCommit()..."
-        app.logger.info("Standard SCORM 2004 processing.")
+        current_app.logger.info("Standard SCORM 2004 processing.")
         if os.path.exists(scorm_2004_js_path):
-            with open(scorm_2004_js_path, 'r+', encoding='utf-8') as f:
+            with open(scorm_2004_js_path, 'r', encoding='utf-8') as f:
                 content = f.read()
-                new_content = content.replace('LMSCommit()', 'SCORM2004_CallCommit()')
-                if content != new_content:
-                    f.seek(0); f.write(new_content); f.truncate()
-                    yield "     ✅ SUCCESS: Replacement complete."
-                    app.logger.info("Successfully replaced LMSCommit() in scorm_2004.js.")
-                else:
-                    yield "     ⚠️ WARNING: 'LMSCommit()' not found. No changes made."
-                    app.logger.warning("'LMSCommit()' not found in scorm_2004.js.")
+            new_content = content.replace('LMSCommit()', 'SCORM2004_CallCommit()')
+            if content != new_content:
+                _write_file_atomically(scorm_2004_js_path, new_content)
+                yield "     ✅ SUCCESS: Replacement complete."
+                current_app.logger.info("Successfully replaced LMSCommit() in scorm_2004.js.")
+            else:
+                yield "     ⚠️ WARNING: 'LMSCommit()' not found. No changes made."
+                current_app.logger.warning("'LMSCommit()' not found in scorm_2004.js.")
         else:
             yield "     ⚠️ WARNING: 'scorm_2004.js' not found. Skipping."
-            app.logger.warning("scorm_2004.js not found, skipping edit.")
+            current_app.logger.warning("scorm_2004.js not found, skipping edit.")
     yield "     ✅ SUCCESS: JS file edits complete."
-    app.logger.info("JS file edits for SCORM 2004 completed.")
+    current_app.logger.info("JS file edits for SCORM 2004 completed.")
 
 
 # --- Main processing stream ---
-def process_package_stream(zip_path, output_dir, scorm_type, is_knowbe4, is_licensed, is_scorm_enabled, logo_data=None, logo_filename=None, license_key=None):
+# --- NEW: Extraction in chunks, so a large member does not stall progress and heartbeats ---
+def iter_extract_member(zip_ref, member, dest_dir):
+    """
+    Same result as `zip_ref.extract(member, dest_dir)` on POSIX, including its
+    path sanitising, but copies the member in chunks and yields the number of
+    bytes written after each one.
+    """
+    parts = [p for p in member.filename.split('/') if p not in ('', os.curdir, os.pardir)]
+    target_path = os.path.normpath(os.path.join(dest_dir, *parts))
+    parent_dir = os.path.dirname(target_path)
+    if parent_dir and not os.path.exists(parent_dir):
+        os.makedirs(parent_dir)
+    if member.is_dir():
+        if not os.path.isdir(target_path):
+            os.mkdir(target_path)
+        return
+    with zip_ref.open(member) as source, open(target_path, 'wb') as target:
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            target.write(chunk)
+            yield len(chunk)
+
+
+def process_package_stream(zip_path, output_dir, scorm_type, is_knowbe4, is_licensed, is_scorm_enabled, logo_data=None, logo_filename=None, license_key=None, encoder=None, journal=None, strict_validation=False, upload=None):
+    """
+    Runs a job as a series of checkpointed steps. Each completed step is written
+    to `journal`, so a job resumed with the same journal skips straight to the
+    first step that had not finished. The working copy and the original upload
+    are only removed once the job reaches a terminal state.
+
+    With `upload` (a PipelinedUpload still being received), the package is
+    processed as it arrives and saved to `zip_path` on the way.
+    """
+    if encoder is None:
+        encoder = ProgressEncoder(journal.job_id, channel=journal)
     base_name = os.path.basename(zip_path)
-    app.logger.info(f"--- Starting new processing job for: {base_name} ---")
-    app.logger.info(f"Parameters: SCORM Type='{scorm_type}', KnowBe4='{is_knowbe4}', Licensed='{is_licensed}', SCORM Enabled='{is_scorm_enabled}'")
+    resuming = bool(journal.completed_steps)
+    if resuming:
+        current_app.logger.info(f"--- Resuming processing job {journal.job_id} for: {base_name} after '{journal.completed_steps[-1]}' ---")
+    else:
+        current_app.logger.info(f"--- Starting new processing job for: {base_name} ---")
+    current_app.logger.info(f"Parameters: SCORM Type='{scorm_type}', KnowBe4='{is_knowbe4}', Licensed='{is_licensed}', SCORM Enabled='{is_scorm_enabled}'")
     
-    temp_extract_dir = os.path.join(output_dir, f"_temp_{base_name}")
-    if os.path.exists(temp_extract_dir): shutil.rmtree(temp_extract_dir)
-    os.makedirs(temp_extract_dir)
-    def format_sse(data, event=None):
-        msg = f'data: {data}\n'
-        if event is not None: msg = f'event: {event}\n{msg}'
-        return f'{msg}\n'
+    temp_extract_dir = journal.work_dir
+    manifest_path = os.path.join(temp_extract_dir, 'imsmanifest.xml')
+    manifest_2004_path = os.path.join(temp_extract_dir, 'imsmanifest_SCORM2004.xml')
+    ctx = dict(journal.ctx)
+    new_zip_name = base_name.replace('.zip', f'_processed_{scorm_type}.zip')
+    scheduler = current_app.extensions['scheduler']
+    # --- NEW: The output archive stays open from the pipelined unzip until the re-zip step ---
+    pipeline = {'active': False, 'archive': None}
+    # --- NEW: Collected for the analytics row written when the attempt ends ---
+    attempt_started_at = time.time()
+    metrics = {'step_durations': {}}
+    memory = JobMemoryTracker()
     try:
-        def main_processing_flow():
+        if resuming:
+            yield from encoder.feed(f"[INFO] Resuming interrupted job after step '{journal.completed_steps[-1]}'.")
+        else:
+            yield from encoder.start()
+
+        # --- NEW: Wait for a fair share of the processing slots before doing any work ---
+        if upload is not None:
+            # Nothing has arrived yet, so only the request size is known.
+            metrics['input_bytes'] = upload.content_length
+            prediction = predict_upload_resources(upload.content_length)
+        else:
+            metrics['input_bytes'] = os.path.getsize(zip_path)
+            prediction = predict_job_resources(zip_path, current_app.extensions['job_analytics'])
+        metrics['uncompressed_bytes'] = prediction.uncompressed_bytes
+        current_app.logger.info(f"Predicted resources for job {journal.job_id}: {prediction}")
+        scheduler.enqueue(journal.job_id, journal.owner, prediction.uncompressed_bytes, priority=journal.params.get('priority', False), resources=prediction)
+        queued_at = time.monotonic()
+        last_position = None
+        for status in scheduler.wait_for_turn(journal.job_id):
+            if status is None:
+                # Nothing new to report; lets the encoder send keep-alives.
+                yield from encoder.feed(ProgressUpdate())
+                continue
+            yield from encoder.feed(ProgressEvent('queue', status))
+            if status['position'] != last_position:
+                last_position = status['position']
+                yield from encoder.feed(f"[QUEUE] Waiting for a processing slot: position {status['position']} of {status['queued']}, estimated start in ~{status['estimated_start_seconds']:.0f}s.")
+        metrics['queue_wait_s'] = round(time.monotonic() - queued_at, 3)
+        memory.start()
+        if last_position is not None:
+            current_app.logger.info(f"Job {journal.job_id} left the queue and is starting.")
+
+        def checkpoint(name, step):
+            """Runs one step unless the journal says it already completed."""
+            if name in journal.completed_steps:
+                return
+            started = time.monotonic()
+            yield from step()
+            metrics['step_durations'][name] = round(time.monotonic() - started, 3)
+            # A pipelined run's working copy only holds the rewrite targets, so it is not
+            # checkpointed; if interrupted, the job reruns on the regular path from the saved upload.
+            if not pipeline['active']:
+                journal.complete_step(name, ctx)
+
+        def unzip_step():
             yield f"[STEP] Unzipping '{base_name}'"
-            app.logger.info(f"Unzipping {base_name} to {temp_extract_dir}")
+            current_app.logger.info(f"Unzipping {base_name} to {temp_extract_dir}")
+            # A partial extraction from an interrupted run is discarded, not trusted.
+            if os.path.exists(temp_extract_dir): shutil.rmtree(temp_extract_dir)
+            os.makedirs(temp_extract_dir)
             with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_extract_dir)
+                members = zip_ref.infolist()
+                metrics['entries'] = len(members)
+                # Extraction and re-zipping each touch every uncompressed byte once.
+                yield ProgressUpdate(total=2 * sum(m.file_size for m in members) or None)
+                for member in members:
+                    for n in iter_extract_member(zip_ref, member, temp_extract_dir):
+                        yield ProgressUpdate(n)
             yield "     ✅ SUCCESS: Package unzipped."
-            app.logger.info("Unzipping complete.")
-            
+            current_app.logger.info("Unzipping complete.")
+
+        def stream_step():
+            yield f"[STEP] Unzipping '{base_name}' as it uploads"
+            current_app.logger.info(f"Processing {base_name} as it uploads to {zip_path}")
+            if os.path.exists(temp_extract_dir): shutil.rmtree(temp_extract_dir)
+            os.makedirs(temp_extract_dir)
+            chunks = upload.iter_file(zip_path)
+            # Never deterministic: wants_pipelined_upload() leaves those to the regular path.
+            archive = ArchiveWriter(os.path.join(output_dir, new_zip_name))
+            yield ProgressUpdate(total=upload.content_length)
+            try:
+                entries = yield from iter_stream_package(
+                    chunks, temp_extract_dir, archive,
+                    lambda name: is_pipeline_rewrite_target(name, logo_filename), pipeline_removed_path)
+                # Only now is the central directory here to confirm what the local headers said.
+                infos = verify_central_directory(zip_path, entries)
+            except NotStreamable as e:
+                archive.abort()
+                yield f"  -> [INFO] This package can't be processed as it uploads ({e}); finishing the upload first."
+                current_app.logger.info(f"Pipelined processing of {base_name} fell back to the regular path: {e}")
+                for _ in chunks:
+                    pass
+                yield from unzip_step()
+                return
+            except BaseException:
+                archive.abort()
+                raise
+            pipeline.update(active=True, archive=archive)
+            metrics['entries'] = len(infos)
+            metrics['uncompressed_bytes'] = sum(i.file_size for i in infos)
+            yield f"  -> Copied {archive.stats['copied']} file(s) into the new package as they arrived."
+            yield "     ✅ SUCCESS: Package unzipped."
+            current_app.logger.info(f"Pipelined unzip complete: {archive.stats['copied']} entries copied, rewrite targets extracted.")
+
+        def validate_step():
             yield "[STEP] Validating SCORM package..."
-            app.logger.info("Validating for imsmanifest.xml")
+            current_app.logger.info("Validating for imsmanifest.xml")
             manifest_path_check = os.path.join(temp_extract_dir, 'imsmanifest.xml')
             if not os.path.exists(manifest_path_check):
-                app.logger.error("Manifest validation failed: imsmanifest.xml not found.")
+                current_app.logger.error("Manifest validation failed: imsmanifest.xml not found.")
                 raise ValueError("The uploaded file is not a valid SCORM package (missing 'imsmanifest.xml').")
             yield "     ✅ SUCCESS: 'imsmanifest.xml' found."
-            app.logger.info("Manifest found.")
+            current_app.logger.info("Manifest found.")
             
             is_iengine5 = os.path.exists(os.path.join(temp_extract_dir, 'scorm'))
-            engine_type = 'iengine5' if is_iengine5 else 'iengine6'
-            yield f"  -> Engine Type detected: {engine_type}"
-            app.logger.info(f"Detected engine type: {engine_type}")
+            ctx['engine_type'] = 'iengine5' if is_iengine5 else 'iengine6'
+            yield f"  -> Engine Type detected: {ctx['engine_type']}"
+            current_app.logger.info(f"Detected engine type: {ctx['engine_type']}")
 
-            yield from clean_unnecessary_files(temp_extract_dir)
-            
-            logo_details = None
-            if logo_data:
-                branding_flow = handle_branding(temp_extract_dir, logo_data, engine_type, logo_filename)
-                while True:
-                    try:
-                        log_line = next(branding_flow)
-                        yield log_line
-                    except StopIteration as e:
-                        logo_details = e.value
-                        break
-            
-            if is_licensed and license_key and engine_type == 'iengine5':
-                yield from handle_license_key(temp_extract_dir, license_key)
-            
-            if engine_type == 'iengine5':
-                yield from handle_iengine5_licensing(temp_extract_dir, is_licensed)
+        def branding_step():
+            branding_flow = handle_branding(temp_extract_dir, logo_data, ctx['engine_type'], logo_filename)
+            while True:
+                try:
+                    log_line = next(branding_flow)
+                    yield log_line
+                except StopIteration as e:
+                    ctx['logo_details'] = e.value
+                    break
 
+        def validate_manifests_step():
             if is_scorm_enabled:
-                app.logger.info("SCORM is enabled, validating manifest files.")
+                current_app.logger.info("SCORM is enabled, validating manifest files.")
                 yield "[STEP] Validating manifest files"
-                manifest_path = os.path.join(temp_extract_dir, 'imsmanifest.xml')
-                manifest_2004_path = os.path.join(temp_extract_dir, 'imsmanifest_SCORM2004.xml')
                 if not (os.path.exists(manifest_path) and os.path.exists(manifest_2004_path)):
-                    app.logger.error("Manifest validation failed.")
+                    current_app.logger.error("Manifest validation failed.")
                     raise ValueError("Package does not contain both 'imsmanifest.xml' and 'imsmanifest_SCORM2004.xml'.")
                 yield "     ✅ SUCCESS: Both manifest files found."
-                app.logger.info("Manifests validated.")
-
-                if scorm_type == '2004':
-                    yield "[STEP] Updating manifest for SCORM 2004"
-                    app.logger.info("Updating manifest for SCORM 2004.")
-                    os.remove(manifest_path); os.rename(manifest_2004_path, manifest_path)
-                elif scorm_type == '1.2':
-                    yield "[STEP] Updating manifest for SCORM 1.2"
-                    app.logger.info("Updating manifest for SCORM 1.2.")
-                    os.remove(manifest_2004_path)
-                yield "     ✅ SUCCESS: Manifest updated."
-                app.logger.info("Manifest update complete.")
+                current_app.logger.info("Manifests validated.")
             else:
                 yield "[INFO] SCORM is disabled, skipping manifest validation and updates."
-                app.logger.info("SCORM is disabled, skipping manifest validation and updates.")
-            
-            yield from edit_admin_settings(temp_extract_dir, scorm_type, engine_type, is_licensed, is_scorm_enabled, logo_details, license_key)
+                current_app.logger.info("SCORM is disabled, skipping manifest validation and updates.")
 
-            if is_scorm_enabled and scorm_type == '2004':
-                js_folder = os.path.join(temp_extract_dir, 'js')
-                yield from edit_js_files_2004(js_folder, is_knowbe4)
+        def update_manifest_step():
+            # Written to be safe to re-run if a previous attempt was interrupted mid-step.
+            if scorm_type == '2004':
+                yield "[STEP] Updating manifest for SCORM 2004"
+                current_app.logger.info("Updating manifest for SCORM 2004.")
+                if os.path.exists(manifest_2004_path):
+                    os.replace(manifest_2004_path, manifest_path)
+            elif scorm_type == '1.2':
+                yield "[STEP] Updating manifest for SCORM 1.2"
+                current_app.logger.info("Updating manifest for SCORM 1.2.")
+                if os.path.exists(manifest_2004_path):
+                    os.remove(manifest_2004_path)
+            yield "     ✅ SUCCESS: Manifest updated."
+            current_app.logger.info("Manifest update complete.")
 
+        def validate_references_step():
+            yield "[STEP] Validating manifest references"
+            current_app.logger.info("Validating imsmanifest.xml references against the package contents.")
+            # The same listing the archive writer will walk, so this checks the output package.
+            entry_index = list_archive_entries(temp_extract_dir)
+            if pipeline['archive'] is not None:
+                entry_index |= pipeline['archive'].names()
+            report = validate_manifest(manifest_path, entry_index)
+            yield ProgressEvent('validation', report)
+            yield (f"  -> Checked {report['files_checked']} reference(s) across {report['resources']} resource(s) "
+                   f"against {len(entry_index)} package entries in {report['elapsed_ms']} ms.")
+            for issue in report['issues'][:20]:
+                yield f"  -> [{issue['severity'].upper()}] {issue['message']}"
+            if report['errors'] + report['warnings'] > 20:
+                yield f"  -> ...and {report['errors'] + report['warnings'] - 20} more issue(s)."
+            current_app.logger.info(f"Manifest validation: {report['errors']} error(s), {report['warnings']} warning(s) in {report['elapsed_ms']} ms.")
+            if report['errors'] and strict_validation:
+                raise ValueError(f"The manifest has {report['errors']} broken reference(s).")
+            if report['errors']:
+                yield f"     ⚠️ WARNING: Found {report['errors']} broken manifest reference(s); the LMS import may fail."
+            else:
+                yield "     ✅ SUCCESS: All manifest references resolve."
+
+        def rezip_step():
             yield "[STEP] Re-zipping the package"
-            app.logger.info("Re-zipping the package.")
-            new_zip_name = base_name.replace('.zip', f'_processed_{scorm_type}.zip')
+            current_app.logger.info("Re-zipping the package.")
             new_zip_path = os.path.join(output_dir, new_zip_name)
-            shutil.make_archive(new_zip_path.replace('.zip', ''), 'zip', temp_extract_dir)
+            blob_store = current_app.extensions['blob_store']
+            # --- MODIFIED: A pipelined upload's archive already holds every entry but the working copy ---
+            if pipeline['archive'] is None:
+                pipeline['archive'] = ArchiveWriter(new_zip_path, deterministic=current_app.config['DETERMINISTIC_ARCHIVES'])
+            order = None
+            if current_app.config['DETERMINISTIC_ARCHIVES']:
+                # --- NEW: Same entry order as the upload, so identical inputs give identical bytes ---
+                with zipfile.ZipFile(zip_path) as source:
+                    order = source.namelist()
+            # --- MODIFIED: Re-base the estimate on what is left to compress, counted as iter_add_tree counts it ---
+            # Earlier steps counted upload bytes (pipelined) or the input's sizes before edits.
+            yield ProgressUpdate(remaining=tree_size(temp_extract_dir))
+            for n in pipeline['archive'].iter_add_tree(temp_extract_dir, blob_store, order):
+                yield ProgressUpdate(n)
+            archive_stats = pipeline['archive'].close()
+            pipeline['archive'] = None
+            # --- NEW: The digest backs the download's ETag and Repr-Digest headers ---
+            write_digest_sidecar(new_zip_path, archive_stats['sha256'])
+            metrics.update(cache_hits=archive_stats['cache_hits'], cache_misses=archive_stats['cache_misses'], output_bytes=archive_stats['bytes_out'])
+            yield f"  -> Reused {archive_stats['cache_hits']} precompressed file(s) from the shared engine cache."
+            current_app.logger.info(f"Archive stats for {new_zip_name}: {archive_stats}; blob store totals: {blob_store.snapshot()}")
             yield f"     ✅ SUCCESS: Created {new_zip_name}"
-            app.logger.info(f"Successfully created processed file: {new_zip_name}")
-            return new_zip_name
+            current_app.logger.info(f"Successfully created processed file: {new_zip_name}")
+            ctx['new_zip_name'] = new_zip_name
+
+        def main_processing_flow():
+            yield from checkpoint('unzip', stream_step if upload is not None else unzip_step)
+            yield from checkpoint('validate', validate_step)
+            engine_type = ctx['engine_type']
+            if not pipeline['active']:
+                # A pipelined upload drops these as its entries arrive.
+                yield from checkpoint('clean', lambda: clean_unnecessary_files(temp_extract_dir))
+            
+            if logo_data:
+                yield from checkpoint('branding', branding_step)
+            
+            if is_licensed and license_key and engine_type == 'iengine5':
+                yield from checkpoint('license_key', lambda: handle_license_key(temp_extract_dir, license_key))
+            
+            if engine_type == 'iengine5':
+                yield from checkpoint('iengine5_licensing', lambda: handle_iengine5_licensing(temp_extract_dir, is_licensed))
+
+            yield from checkpoint('validate_manifests', validate_manifests_step)
+            if is_scorm_enabled:
+                yield from checkpoint('update_manifest', update_manifest_step)
+            yield from checkpoint('validate_references', validate_references_step)
+            
+            yield from checkpoint('admin_settings', lambda: edit_admin_settings(temp_extract_dir, scorm_type, engine_type, is_licensed, is_scorm_enabled, ctx.get('logo_details'), license_key))
+
+            if is_scorm_enabled and scorm_type == '2004':
+                js_folder = os.path.join(temp_extract_dir, 'js')
+                yield from checkpoint('js_2004', lambda: edit_js_files_2004(js_folder, is_knowbe4))
+
+            yield from checkpoint('rezip', rezip_step)
+            return ctx['new_zip_name']
         
         flow = main_processing_flow()
         final_filename = None
         while True:
             try:
-                log_line = next(flow)
-                yield format_sse(log_line)
+                item = next(flow)
+                scheduler.heartbeat(journal.job_id)
+                memory.sample()
+                yield from encoder.feed(item)
             except StopIteration as e:
                 final_filename = e.value
                 break
         if final_filename:
             download_url = f"/download/{final_filename}"
-            yield format_sse(f'{{"url": "{download_url}", "filename": "{final_filename}"}}', 'done')
-            app.logger.info(f"--- Successfully finished processing job for: {base_name} ---")
+            yield from encoder.done({"url": download_url, "filename": final_filename})
+            current_app.logger.info(f"--- Successfully finished processing job for: {base_name} ---")
     except Exception as e:
-        app.logger.error(f"--- Processing job for {base_name} failed: {e} ---", exc_info=True)
-        yield format_sse(f'{{"message": "FATAL ERROR: {str(e)}"}}', 'error')
+        current_app.logger.error(f"--- Processing job for {base_name} failed: {e} ---", exc_info=True)
+        yield from encoder.error(f"FATAL ERROR: {str(e)}")
     finally:
-        if os.path.exists(temp_extract_dir):
-            shutil.rmtree(temp_extract_dir)
-        if os.path.exists(zip_path):
-            try:
-                os.remove(zip_path)
-                app.logger.info(f"Successfully purged original upload: {os.path.basename(zip_path)}")
-            except OSError as e:
-                app.logger.error(f"Error purging original upload {os.path.basename(zip_path)}: {e}")
+        if pipeline['archive'] is not None:
+            pipeline['archive'].abort()
+        # --- MODIFIED: Only a terminal job gives up its working copy and upload ---
+        if journal.is_terminal:
+            journal.discard_work()
+            if os.path.exists(zip_path):
+                try:
+                    upload_dir = os.path.dirname(zip_path)
+                    if os.path.basename(upload_dir) == journal.job_id:
+                        shutil.rmtree(upload_dir)
+                    else:
+                        os.remove(zip_path)
+                    current_app.logger.info(f"Successfully purged original upload: {os.path.basename(zip_path)}")
+                except OSError as e:
+                    current_app.logger.error(f"Error purging original upload {os.path.basename(zip_path)}: {e}")
+        else:
+            current_app.logger.warning(f"Job {journal.job_id} for {base_name} was interrupted; keeping its upload for resumption.")
+        # A resumed job queues again, so an interrupted one gives up its slot too.
+        try:
+            scheduler.finish(journal.job_id)
+        except Exception as e:
+            current_app.logger.error(f"Could not release scheduler slot for job {journal.job_id}: {e}")
+        # --- NEW: One analytics row per attempt, written by a background thread ---
+        metrics['rss_growth_bytes'] = memory.finish()
+        current_app.extensions['job_analytics'].record(dict(
+            metrics,
+            job_id=journal.job_id,
+            sub=journal.owner,
+            attempt_started_at=attempt_started_at,
+            finished_at=time.time(),
+            duration_s=round(time.time() - attempt_started_at - metrics.get('queue_wait_s', 0), 3),
+            outcome=journal.state if journal.is_terminal else 'interrupted',
+            resumed=resuming,
+            engine_type=ctx.get('engine_type'),
+            scorm_type=scorm_type,
+            options={
+                'is_knowbe4': is_knowbe4,
+                'is_licensed': is_licensed,
+                'is_scorm_enabled': is_scorm_enabled,
+                'branding': bool(logo_data),
+                'license_key': bool(license_key),
+                'strict_validation': strict_validation,
+                'priority': journal.params.get('priority', False),
+                'pipelined': pipeline['active'],
+            },
+        ))
+        journal.release()
+
+
+def resume_job_stream(journal, last_seq):
+    """Replays what a reconnecting client missed, then continues an orphaned job from its journal."""
+    for _, frame in journal.frames_after(last_seq):
+        yield frame
+    params = dict(journal.params)
+    params.pop('progress_format', None)
+    params.pop('priority', None)
+    # Kept out of the journalled params; see JobJournal.create.
+    license_key = journal.read_license_key()
+    if license_key is not None:
+        params['license_key'] = license_key
+    logo_bytes = journal.read_logo()
+    encoder = ProgressEncoder(journal.job_id, channel=journal, compat=journal.params.get('progress_format') == 'text')
+    encoder.restore(journal.last_seq, journal.last_progress_payload())
+    yield from process_package_stream(
+        logo_data=io.BytesIO(logo_bytes) if logo_bytes is not None else None,
+        encoder=encoder,
+        journal=journal,
+        **params
+    )
+
+
+def run_job_to_completion(job_id, profile=False):
+    """
+    Job executor entry point (SERVER_MODE=asgi, and profiled jobs under WSGI):
+    runs, or resumes, a journalled job with no client attached. Progress frames
+    only go to the journal, which the front-end streams to clients.
+    """
+    # Runs in a process of its own, whose app is the one built when it imported this module.
+    with app.app_context():
+        journal = JobJournal.load(current_app.config['JOBS_FOLDER'], job_id)
+        if journal is None or journal.is_terminal or not journal.acquire():
+            return
+        stream = resume_job_stream(journal, journal.last_seq)
+        if profile:
+            stream = profile_stream(stream, os.path.join(current_app.config['PROFILE_FOLDER'], job_id), current_app.logger)
+        for _ in stream:
+            pass
+
+def dispatch_job(job_id, profile=False):
+    """
+    Hands a job to the executor process pool and returns its future. A job that
+    is already queued or running in the pool is not submitted twice.
+    """
+    dispatched = current_app.extensions['dispatched_jobs']
+    future = dispatched.get(job_id)
+    if future is not None and not future.done():
+        return future
+    future = current_app.extensions['job_executor'].submit(run_job_to_completion, job_id, profile)
+    dispatched[job_id] = future
+    logger = current_app.logger  # the callback runs on the executor's thread, outside any app context
+    def forget(f):
+        dispatched.pop(job_id, None)
+        if f.exception() is not None:
+            logger.error(f"Job executor failed for job {job_id}: {f.exception()}")
+    future.add_done_callback(forget)
+    return future
+
+
+# --- NEW: Profiled jobs get a process to themselves ---
+def profiled_job_running():
+    """True while this worker's profiled job process is still alive."""
+    process = current_app.extensions.get('profiled_job')
+    return process is not None and process.is_alive()
+
+def dispatch_profiled_job(job_id):
+    """
+    Runs a journalled job under the profiler in a freshly spawned process and
+    returns that process. cProfile (on 3.12) and tracemalloc are process-wide,
+    so profiling inside a gevent worker would collect every other greenlet's
+    work and trip over a second profiled job. Callers keep it to one at a time
+    per worker (see profiled_job_running).
+    """
+    process = multiprocessing.get_context('spawn').Process(target=run_job_to_completion, args=(job_id, True))
+    process.start()
+    current_app.extensions['profiled_job'] = process
+    return process
 
 
 # --- API Endpoints ---
@@ -508,76 +922,292 @@ def _purge_directory(directory):
             elif os.path.isdir(file_path):
                 shutil.rmtree(file_path)
         except Exception as e:
-            app.logger.error(f'Failed to delete {file_path}. Reason: {e}')
+            current_app.logger.error(f'Failed to delete {file_path}. Reason: {e}')
 
-@app.route('/api/purge', methods=['POST'])
+@api.route('/api/purge', methods=['POST'])
 @requires_auth
 def purge_workspace(jwt_payload):
     """Endpoint to clean the workspace before a new batch upload."""
-    app.logger.info("Received request to purge workspace.")
+    current_app.logger.info("Received request to purge workspace.")
     try:
-        upload_folder = app.config['UPLOAD_FOLDER']
-        processed_folder = app.config['PROCESSED_FOLDER']
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        processed_folder = current_app.config['PROCESSED_FOLDER']
         
-        app.logger.info(f"Purging directory: {upload_folder}")
+        current_app.logger.info(f"Purging directory: {upload_folder}")
         _purge_directory(upload_folder)
         
-        app.logger.info(f"Purging directory: {processed_folder}")
+        current_app.logger.info(f"Purging directory: {processed_folder}")
         _purge_directory(processed_folder)
+
+        # --- NEW: Journals of jobs nobody is running go too, with any license keys they hold ---
+        prune_journals(current_app.config['JOBS_FOLDER'], current_app.logger, max_age=0, interval=0)
         
-        app.logger.info("Workspace purged successfully.")
+        current_app.logger.info("Workspace purged successfully.")
         return jsonify({"status": "success", "message": "Workspace purged successfully."}), 200
     except Exception as e:
-        app.logger.error(f"An error occurred during workspace purge: {e}", exc_info=True)
+        current_app.logger.error(f"An error occurred during workspace purge: {e}", exc_info=True)
         return jsonify({"status": "error", "message": "An error occurred during cleanup."}), 500
 
-@app.route('/api/process', methods=['POST'])
-@limiter.limit("20 per minute")
+def wants_pipelined_upload():
+    """
+    Clients opt in with `X-Upload-Mode: pipelined` and must send the package as
+    the last form part. Not available in ASGI mode, where the request body is
+    buffered before Flask sees it and the job runs in another process, nor with
+    deterministic archives: a pipelined archive keeps the upload's deflate
+    streams and appends rewritten files last, so its bytes would depend on the
+    deployment rather than only on the input and options.
+    """
+    return (request.headers.get('X-Upload-Mode') == 'pipelined'
+            and current_app.config['PIPELINED_UPLOADS']
+            and not current_app.config['DETERMINISTIC_ARCHIVES']
+            and current_app.config['SERVER_MODE'] != 'asgi'
+            and request.mimetype == 'multipart/form-data')
+
+@api.route('/api/process', methods=['POST'])
+@limiter.limit(PROCESS_RATE_LIMIT)
 @requires_auth
 def process_scorm_file(jwt_payload):
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part"}), 400
-    file = request.files['file']
-    logo_file = request.files.get('logo', None)
-    scorm_type = request.form.get('scorm_type', '2004')
-    is_knowbe4 = request.form.get('is_knowbe4') == 'true'
-    license_key = request.form.get('license_key', None)
+    # --- NEW: Pipelined uploads are read part by part, so the package can be processed as it arrives ---
+    upload = None
+    if wants_pipelined_upload():
+        try:
+            upload = PipelinedUpload(request.stream, request.mimetype_params.get('boundary'), request.content_length)
+            upload_filename = upload.read_form()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        form = upload.fields
+        logo_upload = upload.files.get('logo')
+    else:
+        if 'file' not in request.files:
+            return jsonify({"error": "No file part"}), 400
+        file = request.files['file']
+        upload_filename = file.filename
+        form = request.form
+        logo_file = request.files.get('logo', None)
+        logo_upload = (logo_file.filename, logo_file.read()) if logo_file else None
+    scorm_type = form.get('scorm_type', '2004')
+    is_knowbe4 = form.get('is_knowbe4') == 'true'
+    license_key = form.get('license_key', None)
     # --- MODIFIED: Get new toggle values from the form ---
-    is_licensed = request.form.get('is_licensed') == 'true'
-    is_scorm_enabled = request.form.get('is_scorm_enabled') == 'true'
+    is_licensed = form.get('is_licensed') == 'true'
+    is_scorm_enabled = form.get('is_scorm_enabled') == 'true'
 
-    if file.filename == '':
+    if upload_filename == '':
         return jsonify({"error": "No selected file"}), 400
     if scorm_type not in ['1.2', '2004']:
         return jsonify({"error": "Invalid scorm_type"}), 400
-    filename = secure_filename(file.filename)
-    upload_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(upload_path)
+    # --- NEW: Profiling is opt-in per job and restricted to operators ---
+    profile_requested = form.get('profile') == 'true' or request.headers.get('X-Profile-Job') == 'true'
+    if profile_requested:
+        requires_profiling_scope(jwt_payload)
+        if current_app.config['SERVER_MODE'] != 'asgi' and profiled_job_running():
+            return jsonify({"error": "A profiled job is already running on this worker; try again when it has finished."}), 409
+    # --- NEW: Optional priority lane in the fair-share scheduler ---
+    priority = form.get('priority') == 'true'
+    if priority:
+        requires_priority_scope(jwt_payload)
+    job_id = uuid.uuid4().hex
+    filename = secure_filename(upload_filename)
+    # --- MODIFIED: Each upload gets its own folder so it can outlive an interrupted worker ---
+    upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], job_id)
+    os.makedirs(upload_dir)
+    upload_path = os.path.join(upload_dir, filename)
+    if upload is None:
+        file.save(upload_path)
+    elif profile_requested:
+        # The profiling process can't read this request, so receive the whole upload first.
+        for _ in upload.iter_file(upload_path):
+            pass
+        upload = None
 
     logo_data = None
     logo_filename = None
-    if logo_file:
-        logo_filename = secure_filename(logo_file.filename)
-        logo_data = io.BytesIO(logo_file.read())
+    if logo_upload:
+        logo_filename = secure_filename(logo_upload[0])
+        logo_data = io.BytesIO(logo_upload[1])
+
+    # --- NEW: Journal the job before starting it so it can be resumed ---
+    prune_journals(current_app.config['JOBS_FOLDER'], current_app.logger)
+    journal = JobJournal.create(current_app.config['JOBS_FOLDER'], job_id, jwt_payload.get('sub'), {
+        'zip_path': upload_path,
+        'output_dir': current_app.config['PROCESSED_FOLDER'],
+        'scorm_type': scorm_type,
+        'is_knowbe4': is_knowbe4,
+        'is_licensed': is_licensed,
+        'is_scorm_enabled': is_scorm_enabled,
+        'logo_filename': logo_filename,
+        'strict_validation': form.get('strict_validation') == 'true',
+        'priority': priority,
+        # 'text' keeps the original one-line-per-frame SSE format
+        'progress_format': form.get('progress_format', 'json'),
+    }, logo_bytes=logo_data.getvalue() if logo_data else None, license_key=license_key)
+    if current_app.config['SERVER_MODE'] == 'asgi':
+        # --- NEW: The work runs in the job executor; the ASGI front-end streams progress from the journal ---
+        dispatch_job(job_id, profile_requested)
+        response = Response(mimetype='text/event-stream')
+        response.headers['X-Job-Id'] = job_id
+        response.headers['X-Job-Dispatched'] = 'true'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
 
-    return Response(process_package_stream(
+    if profile_requested:
+        # --- MODIFIED: Profiled in a process of its own; this response streams its progress from the journal ---
+        current_app.logger.info(f"Profiling job {job_id} for {filename} (requested by {jwt_payload.get('sub')}).")
+        process = dispatch_profiled_job(job_id)
+        response = Response(journal.follow(0, dispatched=process), mimetype='text/event-stream')
+        response.headers['X-Job-Id'] = job_id
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    journal.acquire()
+    encoder = ProgressEncoder(job_id, channel=journal, compat=journal.params['progress_format'] == 'text')
+
+    stream = process_package_stream(
         upload_path, 
-        app.config['PROCESSED_FOLDER'], 
+        current_app.config['PROCESSED_FOLDER'], 
         scorm_type, 
         is_knowbe4, 
         is_licensed, 
         is_scorm_enabled, 
         logo_data, 
         logo_filename, 
-        license_key
-    ), mimetype='text/event-stream')
+        license_key,
+        encoder,
+        journal,
+        journal.params['strict_validation'],
+        upload,
+    )
+    # The steps use current_app, so the generator keeps the request's context while it streams.
+    response = Response(stream_with_context(stream), mimetype='text/event-stream')
+    # Covers a client that disconnects before the stream ever starts.
+    response.call_on_close(journal.release)
+    response.headers['X-Job-Id'] = job_id
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# --- NEW: Resume a progress stream (and, if orphaned, the job itself) ---
+def open_job_events(jwt_payload, job_id, last_event_id):
+    """Shared by the Flask and ASGI events endpoints: returns (journal, last_seq, None) or (None, None, (error, status))."""
+    journal = JobJournal.load(current_app.config['JOBS_FOLDER'], secure_filename(job_id))
+    if journal is None or journal.owner != jwt_payload.get('sub'):
+        return None, None, ({"error": "Unknown job"}, 404)
+    try:
+        return journal, int(last_event_id), None
+    except ValueError:
+        return None, None, ({"error": "Invalid Last-Event-ID"}, 400)
+
+@api.route('/api/jobs/<job_id>/events', methods=['GET'])
+@requires_auth
+def job_events(jwt_payload, job_id):
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '0')
+    journal, last_seq, error = open_job_events(jwt_payload, job_id, last_event_id)
+    if error:
+        return jsonify(error[0]), error[1]
+    if not journal.is_terminal and journal.acquire():
+        # Nobody holds the run lock: the worker that owned this job is gone.
+        current_app.logger.info(f"Resuming orphaned job {journal.job_id} after {journal.completed_steps[-1:] or 'no steps'}.")
+        stream = resume_job_stream(journal, last_seq)
+    else:
+        stream = journal.follow(last_seq)
+    response = Response(stream_with_context(stream), mimetype='text/event-stream')
+    response.call_on_close(journal.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# --- NEW: Profiling artifact endpoints (operator scope only) ---
+@api.route('/api/profiles/<job_id>', methods=['GET'])
+@requires_auth
+def list_profile_artifacts(jwt_payload, job_id):
+    requires_profiling_scope(jwt_payload)
+    profile_dir = os.path.join(current_app.config['PROFILE_FOLDER'], secure_filename(job_id))
+    if not os.path.isdir(profile_dir):
+        return jsonify({"error": "Unknown profiling job"}), 404
+    artifacts = [name for name in PROFILE_ARTIFACTS if os.path.exists(os.path.join(profile_dir, name))]
+    return jsonify({"job_id": job_id, "artifacts": [{"name": name, "url": f"/api/profiles/{job_id}/{name}"} for name in artifacts]})
+
+@api.route('/api/profiles/<job_id>/<artifact>', methods=['GET'])
+@requires_auth
+def download_profile_artifact(jwt_payload, job_id, artifact):
+    requires_profiling_scope(jwt_payload)
+    if artifact not in PROFILE_ARTIFACTS:
+        return jsonify({"error": "Unknown profiling artifact"}), 404
+    profile_dir = os.path.join(current_app.config['PROFILE_FOLDER'], secure_filename(job_id))
+    return send_from_directory(profile_dir, artifact, as_attachment=True, mimetype=PROFILE_ARTIFACTS[artifact])
 
-@app.route('/download/<path:filename>')
+# --- NEW: Capacity-planning queries over historical jobs ---
+@api.route('/api/analytics/jobs', methods=['GET'])
+@requires_auth
+def job_analytics_summary(jwt_payload):
+    requires_analytics_scope(jwt_payload)
+    try:
+        window = parse_duration(request.args.get('window'), 7 * 86400)
+        bucket = parse_duration(request.args.get('bucket'), 86400)
+        min_mb = request.args.get('min_mb', type=float)
+        max_mb = request.args.get('max_mb', type=float)
+    except ValueError:
+        return jsonify({"error": "Invalid window or bucket"}), 400
+    if any(v is not None and not math.isfinite(v) for v in (min_mb, max_mb)):
+        return jsonify({"error": "min_mb and max_mb must be finite numbers"}), 400
+    if window <= 0 or bucket <= 0 or window / bucket > 1000:
+        return jsonify({"error": "window and bucket must be positive, with at most 1000 buckets"}), 400
+    summary = current_app.extensions['job_analytics'].summary(
+        window,
+        bucket,
+        engine_type=request.args.get('engine_type'),
+        min_bytes=min_mb * 1e6 if min_mb is not None else None,
+        max_bytes=max_mb * 1e6 if max_mb is not None else None,
+    )
+    scheduler = current_app.extensions['scheduler']
+    if hasattr(scheduler, 'budget_snapshot'):
+        summary['current_budget'] = scheduler.budget_snapshot()
+    return jsonify(summary)
+
+@api.route('/download/<path:filename>')
 @requires_auth
 def download_file(jwt_payload, filename):
-    return send_from_directory(app.config['PROCESSED_FOLDER'], filename, as_attachment=True)
+    response = build_download_response(filename, request.environ)
+    if response is None:
+        return jsonify({"error": "File not found"}), 404
+    return response
 
-@app.route('/api/batch_download', methods=['POST'])
+def build_download_response(filename, environ):
+    """
+    Download response for a processed file, or None if there is none. Shared by
+    the Flask route and the ASGI front-end, which passes its own WSGI-style environ.
+    """
+    # --- MODIFIED: Strong validators and digests so interrupted downloads resume and can be verified ---
+    file_path = safe_join(current_app.config['PROCESSED_FOLDER'], filename)
+    if file_path is None or filename.endswith(DIGEST_SUFFIX) or not os.path.isfile(file_path):
+        return None
+    sha256_hex = read_digest_sidecar(file_path)
+    digest_headers = {}
+    if sha256_hex:
+        b64 = base64.b64encode(bytes.fromhex(sha256_hex)).decode('ascii')
+        digest_headers = {'Repr-Digest': f"sha-256=:{b64}:", 'Digest': f"SHA-256={b64}"}
+
+    accel_prefix = current_app.config['DOWNLOAD_ACCEL_REDIRECT']
+    if accel_prefix:
+        # nginx serves the bytes (with its own Range handling) from an internal location.
+        # Its own ETag is mtime-size, so the digest ETag is set here and passed on by
+        # nginx (`etag off` there), and If-None-Match is answered here against it.
+        if sha256_hex and not is_resource_modified(environ, etag=sha256_hex):
+            response = Response(status=304)
+        else:
+            response = Response(mimetype='application/zip')
+            response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + filename
+            response.headers['Content-Disposition'] = f'attachment; filename="{os.path.basename(filename)}"'
+        if sha256_hex:
+            response.set_etag(sha256_hex)
+        response.headers.update(digest_headers)
+        return response
+
+    # conditional=True handles Range, If-Range, If-None-Match and If-Modified-Since;
+    # full-body responses go through the server's file wrapper (sendfile).
+    response = send_file_for_environ(os.path.abspath(file_path), environ, as_attachment=True, conditional=True, etag=sha256_hex or True)
+    response.headers.update(digest_headers)
+    return response
+
+@api.route('/api/batch_download', methods=['POST'])
 @requires_auth
 def batch_download(jwt_payload):
     filenames = request.json.get('filenames')
@@ -588,17 +1218,141 @@ def batch_download(jwt_payload):
     memory_file = io.BytesIO()
     with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
         for f in safe_filenames:
-            file_path = os.path.join(app.config['PROCESSED_FOLDER'], f)
+            file_path = os.path.join(current_app.config['PROCESSED_FOLDER'], f)
             if os.path.exists(file_path):
                 zf.write(file_path, arcname=f)
     memory_file.seek(0)
     
     for f in safe_filenames:
-        file_path = os.path.join(app.config['PROCESSED_FOLDER'], f)
+        file_path = os.path.join(current_app.config['PROCESSED_FOLDER'], f)
         if os.path.exists(file_path):
             os.remove(file_path)
+        if os.path.exists(file_path + DIGEST_SUFFIX):
+            os.remove(file_path + DIGEST_SUFFIX)
             
     return send_file(memory_file, download_name='scorm_batch.zip', as_attachment=True)
 
+# --- NEW: Warm-up hooks (run once, in the gunicorn master when preloading) ---
+def preload_static_assets(app):
+    """Reads everything in special_files/ into memory."""
+    assets = {}
+    special_dir = os.path.dirname(app.config['KNOWBE4_FILE_PATH'])
+    for name in os.listdir(special_dir):
+        path = os.path.join(special_dir, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                assets[os.path.normpath(path)] = f.read()
+    app.extensions['static_assets'] = assets
+
+def preload_jwks(app):
+    app.extensions['jwks'].refresh()
+
+def preload_optional_modules(app):
+    """Imports modules the request path would otherwise import lazily."""
+    if app.config['PRELOAD_OPTIONAL_MODULES']:
+        import PIL.Image  # noqa: F401
+        PIL.Image.init()
+
+WARMUP_HOOKS = [preload_static_assets, preload_jwks, preload_optional_modules]
+
+
+# --- NEW: Application factory ---
+def create_app():
+    app = Flask(__name__)
+    CORS(app)
+
+    # --- REVISED: Auth0 Configuration from Environment Variables ---
+    app.config['AUTH0_DOMAIN'] = os.environ.get('AUTH0_DOMAIN')
+    app.config['API_AUDIENCE'] = os.environ.get('API_AUDIENCE')
+    # Validate that the environment variables are set
+    if not all([app.config['AUTH0_DOMAIN'], app.config['API_AUDIENCE']]):
+        raise RuntimeError("Missing required Auth0 environment variables (AUTH0_DOMAIN, API_AUDIENCE).")
+
+    limiter.init_app(app)
+
+    # --- NEW: Setup logging from the external file ---
+    setup_logging(app)
+
+    app.config['UPLOAD_FOLDER'] = 'uploads'
+    app.config['PROCESSED_FOLDER'] = 'processed'
+    app.config['KNOWBE4_FILE_PATH'] = 'special_files/scorm_2004.js'
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
+    # --- NEW: Set to nginx's internal location (e.g. /protected-downloads/) to hand downloads to nginx ---
+    app.config['DOWNLOAD_ACCEL_REDIRECT'] = os.environ.get('DOWNLOAD_ACCEL_REDIRECT', '')
+    # --- NEW: 'asgi' when served by asgi.py (uvicorn); jobs then run in a separate executor ---
+    app.config['SERVER_MODE'] = os.environ.get('SERVER_MODE', 'wsgi')
+    # --- NEW: Lets clients that send `X-Upload-Mode: pipelined` have their package processed as it uploads ---
+    # Deterministic jobs (below) always take the regular path instead.
+    app.config['PIPELINED_UPLOADS'] = os.environ.get('PIPELINED_UPLOADS', 'true').lower() == 'true'
+    # --- NEW: Opt-in mode: input entry order, fixed timestamps and permissions, so the same input and options give the same bytes ---
+    app.config['DETERMINISTIC_ARCHIVES'] = os.environ.get('DETERMINISTIC_ARCHIVES', 'false').lower() == 'true'
+
+    # --- NEW: Content-addressed store of precompressed entries shared across courses ---
+    app.config['BLOB_STORE_FOLDER'] = os.environ.get('BLOB_STORE_FOLDER', 'blob_cache')
+    app.config['BLOB_STORE_MAX_BYTES'] = int(os.environ.get('BLOB_STORE_MAX_MB', '512')) * 1024 * 1024
+    app.extensions['blob_store'] = BlobStore(
+        app.config['BLOB_STORE_FOLDER'],
+        max_bytes=app.config['BLOB_STORE_MAX_BYTES'],
+        logger=app.logger,
+    )
+
+    # --- NEW: Profiling artifacts live outside PROCESSED_FOLDER so /download cannot reach them ---
+    app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', 'profiles')
+    app.config['PROFILING_SCOPE'] = os.environ.get('PROFILING_SCOPE', 'admin:profile')
+    os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+
+    # --- NEW: Job journals (checkpoints, progress frames, working copies) ---
+    app.config['JOBS_FOLDER'] = os.environ.get('JOBS_FOLDER', 'jobs')
+    os.makedirs(app.config['JOBS_FOLDER'], exist_ok=True)
+
+    # --- NEW: Fair-share scheduler; its state is shared by all workers through SQLite ---
+    app.config['SCHEDULER_DB'] = os.environ.get('SCHEDULER_DB', os.path.join(app.config['JOBS_FOLDER'], 'scheduler.db'))
+    # --- MODIFIED: With the adaptive budget on, the running limit is only a safety ceiling ---
+    app.config['ADAPTIVE_CONCURRENCY'] = os.environ.get('ADAPTIVE_CONCURRENCY', 'true') == 'true'
+    default_max_running = 4 * available_cores() if app.config['ADAPTIVE_CONCURRENCY'] else os.environ.get('GUNICORN_WORKERS', available_cores())
+    app.config['SCHEDULER_MAX_RUNNING'] = int(os.environ.get('SCHEDULER_MAX_RUNNING', default_max_running))
+    app.config['SCHEDULER_PER_USER_LIMIT'] = int(os.environ.get('SCHEDULER_PER_USER_LIMIT', '2'))
+    app.config['SCHEDULER_USER_WEIGHTS'] = json.loads(os.environ.get('SCHEDULER_USER_WEIGHTS', '{}'))
+    app.config['SCHEDULER_PRIORITY_SCOPE'] = os.environ.get('SCHEDULER_PRIORITY_SCOPE', 'process:priority')
+    scheduler_options = dict(
+        max_running=app.config['SCHEDULER_MAX_RUNNING'],
+        per_user_limit=app.config['SCHEDULER_PER_USER_LIMIT'],
+        user_weights=app.config['SCHEDULER_USER_WEIGHTS'],
+        logger=app.logger,
+    )
+    if app.config['ADAPTIVE_CONCURRENCY']:
+        # Leave headroom for the workers' own baseline memory.
+        app.config['MEMORY_BUDGET_BYTES'] = int(os.environ.get('MEMORY_BUDGET_MB', 0)) * 1024 * 1024 or int(0.6 * memory_limit_bytes())
+        app.config['CPU_BUDGET'] = float(os.environ.get('CPU_BUDGET', available_cores()))
+        app.extensions['scheduler'] = AdaptiveScheduler(
+            app.config['SCHEDULER_DB'],
+            memory_budget_bytes=app.config['MEMORY_BUDGET_BYTES'],
+            cpu_budget=app.config['CPU_BUDGET'],
+            scratch_dir=app.config['JOBS_FOLDER'],
+            **scheduler_options
+        )
+    else:
+        app.extensions['scheduler'] = FairShareScheduler(app.config['SCHEDULER_DB'], **scheduler_options)
+
+    # --- NEW: Per-job analytics store ---
+    app.config['ANALYTICS_DB'] = os.environ.get('ANALYTICS_DB', os.path.join(app.config['JOBS_FOLDER'], 'analytics.db'))
+    app.config['ANALYTICS_SCOPE'] = os.environ.get('ANALYTICS_SCOPE', 'admin:analytics')
+    app.extensions['job_analytics'] = JobAnalytics(app.config['ANALYTICS_DB'], logger=app.logger)
+
+    app.extensions['jwks'] = JWKSCache(f"https://{app.config['AUTH0_DOMAIN']}/.well-known/jwks.json")
+    app.config['PRELOAD_OPTIONAL_MODULES'] = os.environ.get('PRELOAD_OPTIONAL_MODULES', 'true') == 'true'
+
+    app.register_blueprint(api)
+    app.before_request(lambda: record_first_request(app))
+
+    run_warmup_hooks(app, WARMUP_HOOKS)
+    report_startup(app)
+    return app
+
+
+# Built at import so `gunicorn --preload app:app` warms everything up once in the master.
+app = create_app()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8080)
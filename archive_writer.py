@@ -0,0 +1,300 @@
+# archive_writer.py
+# --- Writes processed packages back to zip, reusing precompressed blobs when possible ---
+
+import io
+import os
+import struct
+import hashlib
+import zipfile
+
+from blob_store import fingerprint_file, CHUNK_SIZE
+
+DIGEST_SUFFIX = '.sha256'
+DATA_DESCRIPTOR_FLAG = 0x08
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+# --- NEW: Metadata every entry of a deterministic archive gets, whatever the working copy's ---
+DETERMINISTIC_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+DETERMINISTIC_FILE_ATTR = 0o100644 << 16
+DETERMINISTIC_DIR_ATTR = (0o40755 << 16) | 0x10  # plus the MS-DOS directory bit, as ZipFile.write sets
+
+
+class HashingWriter:
+    """
+    Write-only wrapper that feeds everything written through it to SHA-256.
+    It refuses to seek, so ZipFile puts each entry's sizes in a trailing data
+    descriptor instead of patching the local header afterwards, and the digest
+    covers the archive byte for byte as it lands on disk.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+        self.offset = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.offset += len(data)
+        return self.fp.write(data)
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation("seek")
+
+    def flush(self):
+        self.fp.flush()
+
+
+def write_digest_sidecar(archive_path, sha256_hex):
+    """Stores the digest next to the archive, in `sha256sum` format."""
+    tmp_path = archive_path + DIGEST_SUFFIX + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(f"{sha256_hex}  {os.path.basename(archive_path)}\n")
+    os.replace(tmp_path, archive_path + DIGEST_SUFFIX)
+
+
+def read_digest_sidecar(archive_path):
+    """Returns the archive's SHA-256 hex digest, or None if it has no (current) sidecar."""
+    sidecar = archive_path + DIGEST_SUFFIX
+    try:
+        if os.path.getmtime(sidecar) < os.path.getmtime(archive_path):
+            return None
+        with open(sidecar, 'r', encoding='utf-8') as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def _needs_zip64(zinfo):
+    # The same test ZipFile._open_to_write applies, so spliced entries get the same header.
+    return zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+
+
+def _begin_raw_entry(zf, zinfo):
+    """
+    Writes the local header of an entry whose deflate stream is copied in as is.
+    Mirrors ZipFile._open_to_write, minus the compressor. With the data-descriptor
+    flag set the sizes follow the data (see _end_raw_entry).
+    """
+    zip64 = _needs_zip64(zinfo)
+    if zf._seekable:
+        zf.fp.seek(zf.start_dir)
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader(zip64))
+
+
+def _end_raw_entry(zf, zinfo):
+    if zinfo.flag_bits & DATA_DESCRIPTOR_FLAG:
+        fmt = '<4sLQQ' if _needs_zip64(zinfo) else '<4sLLL'
+        zf.fp.write(struct.pack(fmt, DATA_DESCRIPTOR_SIGNATURE, zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+
+
+def _write_raw_entry(zf, zinfo, raw_data):
+    """Appends an entry whose deflate stream is already known."""
+    _begin_raw_entry(zf, zinfo)
+    zf.fp.write(raw_data)
+    _end_raw_entry(zf, zinfo)
+
+
+def _read_raw_entry(fp, zinfo):
+    """Reads the compressed bytes of an entry straight from the archive file."""
+    fp.seek(zinfo.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    name_len = int.from_bytes(header[26:28], 'little')
+    extra_len = int.from_bytes(header[28:30], 'little')
+    fp.seek(zinfo.header_offset + zipfile.sizeFileHeader + name_len + extra_len)
+    return fp.read(zinfo.compress_size)
+
+
+def _copy_into_archive(zf, path, zinfo):
+    """Compresses one file into the archive in chunks, yielding bytes read."""
+    zinfo.compress_type = zf.compression
+    zinfo._compresslevel = zf.compresslevel
+    with open(path, 'rb') as src, zf.open(zinfo, 'w') as dest:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            dest.write(chunk)
+            yield len(chunk)
+
+
+def _walk_tree(src_dir, sort_files):
+    """(arcname, path, is_dir) for everything under `src_dir`, directories before their contents."""
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        arcdirpath = os.path.relpath(dirpath, src_dir).replace(os.sep, '/')
+        prefix = '' if arcdirpath == '.' else arcdirpath + '/'
+        for name in dirnames:
+            yield prefix + name + '/', os.path.join(dirpath, name), True
+        for name in (sorted(filenames) if sort_files else filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path):
+                yield prefix + name, path, False
+
+
+def input_order_key(names):
+    """
+    Sort key for arcnames that follows `names` (the entries of the input
+    archive, in order). Directories the input does not list go just before
+    their first entry; anything new goes last, by name.
+    """
+    position = {}
+    for index, name in enumerate(names):
+        position.setdefault(name, (index, 0))
+        parts = name.rstrip('/').split('/')
+        for depth in range(1, len(parts)):
+            position.setdefault('/'.join(parts[:depth]) + '/', (index, -1))
+    last = (len(names), 1)
+    return lambda arcname: position.get(arcname, last) + (arcname,)
+
+
+def list_archive_entries(src_dir):
+    """Returns the set of file arcnames ArchiveWriter.iter_add_tree would write for `src_dir`."""
+    src_dir = os.path.normpath(src_dir)
+    entries = set()
+    for dirpath, _, filenames in os.walk(src_dir):
+        arcdirpath = os.path.relpath(dirpath, src_dir).replace(os.sep, '/')
+        for name in filenames:
+            entries.add(name if arcdirpath == '.' else f"{arcdirpath}/{name}")
+    return entries
+
+
+def tree_size(src_dir):
+    """Returns the uncompressed bytes iter_add_tree would report for `src_dir`."""
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, _, filenames in os.walk(src_dir) for name in filenames)
+
+
+class ArchiveWriter:
+    """
+    An archive being written in stages. Entries can be copied in raw as they
+    arrive (pipelined uploads) before a directory tree is added with
+    iter_add_tree; close() finishes the archive and returns its stats.
+    """
+
+    def __init__(self, dest_path, compresslevel=6, deterministic=False):
+        self.dest_path = dest_path
+        self.deterministic = deterministic
+        self.stats = {'entries': 0, 'cache_hits': 0, 'cache_misses': 0, 'cache_stored': 0, 'bytes_in': 0, 'bytes_reused': 0,
+                      'copied': 0, 'bytes_copied': 0}
+        self._to_store = []
+        self._raw_fp = open(dest_path, 'wb')
+        self._hashing_fp = HashingWriter(self._raw_fp)
+        self.zf = zipfile.ZipFile(self._hashing_fp, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+
+    def _normalize(self, zinfo):
+        """In deterministic mode, drops the timestamp and permissions the working copy happened to have."""
+        if self.deterministic:
+            zinfo.date_time = DETERMINISTIC_DATE_TIME
+            zinfo.external_attr = DETERMINISTIC_DIR_ATTR if zinfo.is_dir() else DETERMINISTIC_FILE_ATTR
+            zinfo.create_system = 3
+        return zinfo
+
+    def _zinfo(self, path, arcname):
+        return self._normalize(zipfile.ZipInfo.from_file(path, arcname))
+
+    def names(self):
+        """Names of the entries written so far."""
+        return set(self.zf.NameToInfo)
+
+    # --- Entries copied without recompression ---
+    def begin_raw_entry(self, zinfo):
+        _begin_raw_entry(self.zf, self._normalize(zinfo))
+
+    def write_raw(self, data):
+        self.zf.fp.write(data)
+
+    def end_raw_entry(self, zinfo):
+        """Completes an entry; zinfo's CRC and sizes must be final by now."""
+        _end_raw_entry(self.zf, zinfo)
+        self.stats['entries'] += 1
+        self.stats['copied'] += 1
+        self.stats['bytes_in'] += zinfo.file_size
+        self.stats['bytes_copied'] += zinfo.file_size
+
+    # --- Entries compressed from a directory ---
+    def iter_add_tree(self, src_dir, blob_store=None, order=None):
+        """
+        Adds `src_dir` with the same layout as shutil.make_archive. Entries
+        already present in `blob_store` are spliced in as stored raw-deflate
+        bytes. With `order` (the input archive's entry names) entries follow
+        the input's order; otherwise directory order, sorted when the archive
+        is deterministic. Yields the number of uncompressed bytes handled.
+        """
+        zf, stats = self.zf, self.stats
+        entries = _walk_tree(os.path.normpath(src_dir), sort_files=self.deterministic)
+        if order is not None:
+            key = input_order_key(order)
+            entries = sorted(entries, key=lambda entry: key(entry[0]))
+        for arcname, path, is_dir in entries:
+            stats['entries'] += 1
+            if is_dir:
+                zinfo = self._zinfo(path, arcname)
+                zinfo.compress_size = zinfo.CRC = 0
+                zf.mkdir(zinfo)
+                continue
+            if blob_store is None or os.path.getsize(path) < blob_store.min_size:
+                # Small files are cheaper to compress than to look up.
+                for n in _copy_into_archive(zf, path, self._zinfo(path, arcname)):
+                    stats['bytes_in'] += n
+                    yield n
+                continue
+
+            crc, size, sha256 = fingerprint_file(path)
+            stats['bytes_in'] += size
+            key = blob_store.make_key(crc, size, sha256)
+            raw_data = blob_store.get(key)
+            if raw_data is not None:
+                zinfo = self._zinfo(path, arcname)
+                zinfo.compress_type = zf.compression
+                zinfo._compresslevel = zf.compresslevel
+                # Lay the entry out exactly as zf.open does on our non-seekable stream
+                # (zeroed local header, trailing data descriptor), so a cache hit
+                # produces the same bytes as a miss.
+                zinfo.flag_bits |= DATA_DESCRIPTOR_FLAG
+                zinfo.CRC = crc
+                zinfo.file_size = size
+                zinfo.compress_size = len(raw_data)
+                _write_raw_entry(zf, zinfo, raw_data)
+                stats['cache_hits'] += 1
+                stats['bytes_reused'] += size
+                yield size
+                continue
+
+            stats['cache_misses'] += 1
+            yield from _copy_into_archive(zf, path, self._zinfo(path, arcname))
+            if blob_store.should_admit(key, size):
+                self._to_store.append((blob_store, key, zf.filelist[-1]))
+
+    def close(self):
+        """Writes the central directory and returns the stats, including the archive's SHA-256."""
+        self.zf.close()
+        self._raw_fp.close()
+        self.stats['sha256'] = self._hashing_fp.sha256.hexdigest()
+        self.stats['bytes_out'] = self._hashing_fp.tell()
+
+        # Harvest the freshly compressed bytes for the store after the archive is complete.
+        if self._to_store:
+            with open(self.dest_path, 'rb') as fp:
+                for blob_store, key, zinfo in self._to_store:
+                    if blob_store.put(key, _read_raw_entry(fp, zinfo)):
+                        self.stats['cache_stored'] += 1
+        return self.stats
+
+    def abort(self):
+        """Abandons the archive and removes what was written of it."""
+        try:
+            self.zf.close()
+        except Exception:
+            pass
+        self._raw_fp.close()
+        if os.path.exists(self.dest_path):
+            os.remove(self.dest_path)
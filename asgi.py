@@ -0,0 +1,249 @@
+# asgi.py
+# --- Async front-end: progress streams and downloads are served natively, everything else by Flask ---
+
+import os
+import re
+import json
+import asyncio
+import multiprocessing
+from urllib.parse import parse_qs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+from limits import parse
+
+from app import (
+    app, limiter, AuthError, decode_auth_header, open_job_events, build_download_response, dispatch_job,
+    DEFAULT_RATE_LIMITS,
+)
+from job_journal import JobJournal
+
+EVENTS_PATH = re.compile(r'^/api/jobs/([^/]+)/events$')
+DOWNLOAD_PREFIX = '/download/'
+DOWNLOAD_BATCH_BYTES = 1024 * 1024
+STREAM_RATE_LIMITS = sorted(parse(limit) for limit in DEFAULT_RATE_LIMITS)
+
+# Jobs run in their own processes so CPU-heavy work never stalls the event loop.
+app.config['SERVER_MODE'] = 'asgi'
+app.config['JOB_EXECUTOR_WORKERS'] = int(os.environ.get('JOB_EXECUTOR_WORKERS', app.config['SCHEDULER_MAX_RUNNING']))
+app.extensions['job_executor'] = ProcessPoolExecutor(
+    max_workers=app.config['JOB_EXECUTOR_WORKERS'],
+    # Spawned, not forked: the event loop and its threads must not be copied into job processes.
+    mp_context=multiprocessing.get_context('spawn'),
+)
+app.extensions['dispatched_jobs'] = {}
+# Blocking file and auth work for the native endpoints.
+io_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('ASGI_IO_THREADS', '8')), thread_name_prefix='asgi-io')
+
+flask_app = WsgiToAsgi(app)
+
+
+# --- Small ASGI helpers ---
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+
+def _build_environ(scope):
+    """The parts of a WSGI environ werkzeug needs to evaluate Range and conditional headers."""
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+    }
+    for name, value in _headers(scope).items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+
+def _in_app_context(func, *args):
+    # The shared helpers use current_app, which only exists inside an app context.
+    with app.app_context():
+        return func(*args)
+
+
+async def _run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(io_executor, _in_app_context, func, *args)
+
+
+async def _send_start(send, status, headers):
+    # Flask adds this through flask-cors; native responses must match.
+    headers = dict(headers, **{'Access-Control-Allow-Origin': '*'})
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()],
+    })
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await _send_start(send, status, {'Content-Type': 'application/json', 'Content-Length': len(body)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _rate_limited(scope, endpoint):
+    """
+    Applies the same default limits Flask-Limiter puts on the Flask routes, with
+    the same storage and keys (remote address, endpoint name), so counters are
+    shared with requests Flask serves. Returns the breached limit, or None.
+    """
+    key = (scope.get('client') or ('127.0.0.1', 0))[0]
+    for limit in STREAM_RATE_LIMITS:
+        if not limiter.limiter.hit(limit, key, endpoint):
+            app.logger.info(f"ratelimit {limit} ({key}) exceeded at endpoint: {endpoint}")
+            return limit
+    return None
+
+
+async def _guard(scope, send, endpoint):
+    """Rate limit, then authenticate (the order Flask uses). Returns the JWT payload or None after responding."""
+    limit = _rate_limited(scope, endpoint)
+    if limit is not None:
+        body = f"429 Too Many Requests: {limit}".encode('utf-8')
+        await _send_start(send, 429, {'Content-Type': 'text/plain; charset=utf-8', 'Content-Length': len(body)})
+        await send({'type': 'http.response.body', 'body': body})
+        return None
+    try:
+        return await _run_blocking(decode_auth_header, _headers(scope).get('authorization'))
+    except AuthError as e:
+        await _send_json(send, e.status_code, e.error)
+        return None
+
+
+async def _stream_frames(receive, send, frames):
+    """Sends SSE frames until the job ends or the client goes away."""
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        async for frame in frames:
+            if disconnected.is_set():
+                return
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        await frames.aclose()
+
+
+# --- Native endpoints ---
+async def job_events(scope, receive, send, job_id):
+    jwt_payload = await _guard(scope, send, 'api.job_events')
+    if jwt_payload is None:
+        return
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    last_event_id = _headers(scope).get('last-event-id') or query.get('last_event_id', ['0'])[0]
+    journal, last_seq, error = await _run_blocking(open_job_events, jwt_payload, job_id, last_event_id)
+    if error:
+        await _send_json(send, error[1], error[0])
+        return
+    dispatched = app.extensions['dispatched_jobs'].get(journal.job_id)
+    if dispatched is None and not journal.is_terminal and journal.acquire():
+        # Nobody holds the run lock: the process that owned this job is gone.
+        journal.release()
+        app.logger.info(f"Resuming orphaned job {journal.job_id} after {journal.completed_steps[-1:] or 'no steps'}.")
+        with app.app_context():
+            dispatched = dispatch_job(journal.job_id)
+    await _send_start(send, 200, {'Content-Type': 'text/event-stream; charset=utf-8', 'Cache-Control': 'no-cache'})
+    await _stream_frames(receive, send, journal.afollow(last_seq, dispatched=dispatched, executor=io_executor))
+
+
+async def download(scope, receive, send, filename):
+    jwt_payload = await _guard(scope, send, 'api.download_file')
+    if jwt_payload is None:
+        return
+    environ = _build_environ(scope)
+    response = await _run_blocking(build_download_response, filename, environ)
+    if response is None:
+        await _send_json(send, 404, {"error": "File not found"})
+        return
+    app_iter = response.get_app_iter(environ)
+    headers = response.get_wsgi_headers(environ)
+    await _send_start(send, response.status_code, dict(headers.items()))
+    chunks = iter(app_iter)
+
+    def read_batch():
+        # Hop to a thread once per ~1 MB rather than once per 8 KB chunk.
+        batch, size = [], 0
+        for chunk in chunks:
+            batch.append(chunk)
+            size += len(chunk)
+            if size >= DOWNLOAD_BATCH_BYTES:
+                break
+        return b''.join(batch)
+
+    try:
+        while True:
+            data = await _run_blocking(read_batch)
+            if not data:
+                break
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(app_iter, 'close'):
+            await _run_blocking(app_iter.close)
+
+
+async def process(scope, receive, send):
+    """
+    Uploads are parsed, authorised and rate limited by the Flask route as before.
+    In ASGI mode it journals the job, hands it to the executor and answers with
+    an empty event stream marked X-Job-Dispatched; the progress is then appended
+    here from the journal instead of from a blocked WSGI thread.
+    """
+    dispatched = {}
+
+    async def intercept(message):
+        if message['type'] == 'http.response.start':
+            headers = dict(message['headers'])
+            if message['status'] == 200 and b'x-job-dispatched' in headers:
+                dispatched['job_id'] = headers[b'x-job-id'].decode('latin-1')
+                message = dict(message, headers=[
+                    (k, v) for k, v in message['headers'] if k not in (b'x-job-dispatched', b'content-length')
+                ])
+        elif message['type'] == 'http.response.body' and dispatched and not message.get('more_body', False):
+            message = dict(message, more_body=True)
+        await send(message)
+
+    await flask_app(scope, receive, intercept)
+    if dispatched:
+        job_id = dispatched['job_id']
+        journal = JobJournal(app.config['JOBS_FOLDER'], job_id)
+        await _stream_frames(receive, send, journal.afollow(0, dispatched=app.extensions['dispatched_jobs'].get(job_id), executor=io_executor))
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            app.logger.info(f"ASGI front-end ready; jobs run in {app.config['JOB_EXECUTOR_WORKERS']} executor process(es).")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            app.extensions['job_executor'].shutdown(wait=False, cancel_futures=True)
+            io_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+        return
+    path, method = scope['path'], scope['method']
+    match = EVENTS_PATH.match(path)
+    if match and method == 'GET':
+        await job_events(scope, receive, send, match.group(1))
+    elif path.startswith(DOWNLOAD_PREFIX) and method in ('GET', 'HEAD'):
+        await download(scope, receive, send, path[len(DOWNLOAD_PREFIX):])
+    elif path == '/api/process' and method == 'POST':
+        await process(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,169 @@
+# blob_store.py
+# --- Content-addressed store of precompressed archive entries shared across jobs ---
+
+import os
+import hashlib
+import threading
+import zlib
+from collections import Counter
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def fingerprint_file(file_path):
+    """
+    Reads a file once and returns its (crc32, size, sha256 hex digest).
+    """
+    crc = 0
+    size = 0
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            sha.update(chunk)
+            size += len(chunk)
+    return crc & 0xFFFFFFFF, size, sha.hexdigest()
+
+
+class BlobStore:
+    """
+    Keeps raw-deflate copies of archive entries on disk, keyed by
+    CRC32 + size + SHA-256 of the uncompressed content.
+
+    Engine runtimes (js/, skins/, fonts, player assets) are identical across
+    courses, so the archive writer can splice these bytes into a new zip
+    instead of compressing the same content again. An entry is only admitted
+    once it has been seen `min_hits` times, and the least recently used
+    blobs are evicted once the store grows past `max_bytes`.
+    """
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024, min_hits=2, min_size=4096, compresslevel=6, logger=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_hits = min_hits
+        self.min_size = min_size
+        self.compresslevel = compresslevel
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._seen = Counter()
+        self._total_bytes = None
+        self.stats = Counter()
+        os.makedirs(self.root, exist_ok=True)
+
+    # --- Keys and paths ---
+    def make_key(self, crc, size, sha256):
+        # The compression level is part of the key so a blob is only ever
+        # spliced into an archive written with the same parameters.
+        return f"{sha256}-{crc:08x}-{size}-z{self.compresslevel}"
+
+    def _blob_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    # --- Lookups ---
+    def get(self, key):
+        """Returns the stored raw-deflate bytes for `key`, or None on a miss."""
+        path = self._blob_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Touch the blob so eviction treats it as recently used.
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+        with self._lock:
+            self.stats['hits'] += 1
+            self.stats['bytes_served'] += len(data)
+        return data
+
+    def should_admit(self, key, size):
+        """Counts one sighting of `key` and reports whether it is now worth storing."""
+        if size < self.min_size:
+            return False
+        with self._lock:
+            # Bound the bookkeeping so a long-lived worker does not grow forever.
+            if len(self._seen) > 100_000:
+                self._seen.clear()
+            self._seen[key] += 1
+            return self._seen[key] >= self.min_hits
+
+    # --- Writes ---
+    def put(self, key, data):
+        """Atomically stores raw-deflate bytes under `key`."""
+        path = self._blob_path(key)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            if self.logger:
+                self.logger.error(f"Could not store blob {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        with self._lock:
+            self.stats['stores'] += 1
+            self.stats['bytes_stored'] += len(data)
+            if self._total_bytes is not None:
+                self._total_bytes += len(data)
+            over_budget = self._total_bytes is None or self._total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+        return True
+
+    # --- Eviction ---
+    def _scan(self):
+        entries = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """Removes least recently used blobs until the store is below 90% of `max_bytes`."""
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+        with self._lock:
+            self._total_bytes = total
+            self.stats['evictions'] += evicted
+        if evicted and self.logger:
+            self.logger.info(f"Blob store evicted {evicted} blob(s); {total} bytes remain.")
+        return evicted
+
+    # --- Reporting ---
+    def snapshot(self):
+        """Returns a copy of the counters plus the current hit rate."""
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        stats['hit_rate'] = round(stats.get('hits', 0) / lookups, 4) if lookups else 0.0
+        return stats
@@ -0,0 +1,258 @@
+# concurrency_controller.py
+# --- Admits jobs into a shared memory / CPU / scratch-disk budget that adapts to observed pressure ---
+
+import os
+import math
+import time
+import shutil
+import zipfile
+from collections import namedtuple
+
+from scheduler import FairShareScheduler
+from job_analytics import percentile
+
+# Extensions whose content is already compressed: cheap to deflate (mostly I/O), never rewritten.
+MEDIA_EXTENSIONS = frozenset([
+    '.mp4', '.m4v', '.webm', '.mov', '.mp3', '.m4a', '.ogg', '.wav',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg', '.woff', '.woff2', '.ttf', '.pdf', '.zip',
+])
+# Files the processing steps read whole into memory to rewrite.
+REWRITTEN_EXTENSIONS = frozenset(['.xml', '.js', '.html', '.htm', '.json'])
+
+BASE_JOB_MEMORY = 32 * 1024 * 1024
+PER_ENTRY_MEMORY = 1024
+MIN_HISTORY_SAMPLES = 5
+
+ADJUST_INTERVAL = 5.0           # seconds between AIMD adjustments (shared by all workers)
+MEMORY_PRESSURE = 0.85          # fraction of the memory limit in use that counts as pressure
+LOAD_PRESSURE = 1.5             # 1-minute load average per core that counts as pressure
+DECREASE_FACTOR = 0.7
+INCREASE_STEP = 0.05
+MIN_BUDGET_FACTOR = 0.2
+
+JobResources = namedtuple('JobResources', ['memory_bytes', 'cores', 'disk_bytes', 'uncompressed_bytes', 'engine_type'])
+
+
+def predict_job_resources(zip_path, analytics=None):
+    """
+    Predicts a job's memory, CPU and scratch-disk use from the upload's central
+    directory (uncompressed size, share of already-compressed media, file count,
+    largest rewritten file) and, when there is enough history, the RSS growth of
+    past jobs of similar size and engine.
+    """
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            infos = zf.infolist()
+    except (zipfile.BadZipFile, OSError):
+        # The job will fail validation anyway; admit it cheaply.
+        size = os.path.getsize(zip_path) if os.path.exists(zip_path) else 0
+        return JobResources(BASE_JOB_MEMORY, 0.25, 2 * size, max(1, size), None)
+
+    uncompressed = sum(i.file_size for i in infos)
+    compressed = sum(i.compress_size for i in infos)
+    media = sum(i.file_size for i in infos if os.path.splitext(i.filename)[1].lower() in MEDIA_EXTENSIONS)
+    largest_rewritten = max((i.file_size for i in infos if os.path.splitext(i.filename)[1].lower() in REWRITTEN_EXTENSIONS), default=0)
+    engine_type = 'iengine5' if any(i.filename.startswith('scorm/') for i in infos) else 'iengine6'
+    media_ratio = media / uncompressed if uncompressed else 0.0
+
+    memory = BASE_JOB_MEMORY + 2 * largest_rewritten + PER_ENTRY_MEMORY * len(infos)
+    if analytics is not None:
+        history = analytics.similar_runs(uncompressed, engine_type)
+        if len(history['rss_growth_bytes']) >= MIN_HISTORY_SAMPLES:
+            # What similar jobs actually added to their worker's RSS, at p90.
+            observed = percentile(history['rss_growth_bytes'], 90)
+            memory = max(BASE_JOB_MEMORY, int(observed))
+    # Deflating text keeps a core busy; copying media is mostly I/O.
+    cores = 0.25 + 0.75 * (1.0 - media_ratio)
+    # Extracted working copy plus the new archive.
+    disk = uncompressed + int(compressed * 1.05)
+    return JobResources(memory, round(cores, 3), disk, max(1, uncompressed), engine_type)
+
+
+def predict_upload_resources(upload_bytes):
+    """
+    Prediction for a pipelined upload, made before any of it has arrived, so
+    only the request size is known. Its entries are copied without being
+    recompressed, so it is mostly I/O; scratch space is the saved upload plus
+    the new archive.
+    """
+    upload_bytes = max(1, upload_bytes or 0)
+    return JobResources(BASE_JOB_MEMORY, 0.25, 2 * upload_bytes, upload_bytes, None)
+
+
+# --- Host capacity and pressure ---
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def _meminfo():
+    values = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, rest = line.split(':', 1)
+                values[name] = int(rest.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return values
+
+
+def memory_limit_bytes():
+    """The container's cgroup memory limit, or the host's total memory."""
+    limit = _read_first_line('/sys/fs/cgroup/memory.max')
+    if limit and limit != 'max':
+        return int(limit)
+    return _meminfo().get('MemTotal', 0)
+
+
+def _cgroup_memory_stat(name):
+    try:
+        with open('/sys/fs/cgroup/memory.stat') as f:
+            for line in f:
+                key, _, value = line.partition(' ')
+                if key == name:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def memory_in_use_fraction():
+    """
+    Working set over the limit. memory.current counts page cache, which this
+    workload fills with every zip it extracts and writes, so reclaimable
+    inactive file pages are left out, as docker stats and the kubelet do and
+    as MemAvailable does on the host.
+    """
+    current = _read_first_line('/sys/fs/cgroup/memory.current')
+    limit = _read_first_line('/sys/fs/cgroup/memory.max')
+    if current and limit and limit != 'max':
+        working_set = max(0, int(current) - _cgroup_memory_stat('inactive_file'))
+        return working_set / int(limit)
+    info = _meminfo()
+    if info.get('MemTotal'):
+        return 1.0 - info.get('MemAvailable', info['MemTotal']) / info['MemTotal']
+    return 0.0
+
+
+def available_cores():
+    """CPUs this process can use: its affinity mask, capped by the container's cgroup CPU quota."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = _read_first_line('/sys/fs/cgroup/cpu.max')  # "<quota> <period>" or "max <period>"
+    if quota and not quota.startswith('max'):
+        try:
+            limit, period = (int(v) for v in quota.split())
+            cores = min(cores, max(1, math.ceil(limit / period)))
+        except ValueError:
+            pass
+    return cores
+
+
+class AdaptiveScheduler(FairShareScheduler):
+    """
+    Fair-share scheduler whose capacity check admits a job only if its predicted
+    memory and CPU fit in what is left of the budget, and its scratch space fits
+    on disk. The budget is `factor` × the configured totals; every ADJUST_INTERVAL
+    the factor shrinks multiplicatively under memory or load pressure and grows
+    additively while jobs are waiting and the host is healthy (AIMD).
+    """
+
+    def __init__(self, db_path, memory_budget_bytes, cpu_budget, scratch_dir, **kwargs):
+        super().__init__(db_path, **kwargs)
+        self.memory_budget_bytes = memory_budget_bytes
+        self.cpu_budget = cpu_budget
+        self.scratch_dir = scratch_dir
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS job_resources (
+                    job_id TEXT PRIMARY KEY,
+                    memory_bytes INTEGER NOT NULL,
+                    cores REAL NOT NULL,
+                    disk_bytes INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS budget (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    factor REAL NOT NULL,
+                    adjusted_at REAL NOT NULL
+                );
+            """)
+            conn.execute("INSERT OR IGNORE INTO budget (id, factor, adjusted_at) VALUES (1, 1.0, 0)")
+
+    def enqueue(self, job_id, sub, cost, priority=False, resources=None):
+        super().enqueue(job_id, sub, cost, priority)
+        if resources is not None:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO job_resources (job_id, memory_bytes, cores, disk_bytes) VALUES (?, ?, ?, ?)",
+                             (job_id, resources.memory_bytes, resources.cores, resources.disk_bytes))
+
+    def finish(self, job_id):
+        super().finish(job_id)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM job_resources WHERE job_id = ?", (job_id,))
+
+    def _expire_stale(self, conn, now):
+        super()._expire_stale(conn, now)
+        conn.execute("DELETE FROM job_resources WHERE job_id NOT IN (SELECT job_id FROM jobs)")
+
+    def _adjust_budget(self, conn, now):
+        factor, adjusted_at = conn.execute("SELECT factor, adjusted_at FROM budget WHERE id = 1").fetchone()
+        if now - adjusted_at < ADJUST_INTERVAL:
+            return factor
+        memory_used = memory_in_use_fraction()
+        load_per_core = os.getloadavg()[0] / available_cores()
+        waiting = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+        new_factor = factor
+        if memory_used > MEMORY_PRESSURE or load_per_core > LOAD_PRESSURE:
+            new_factor = max(MIN_BUDGET_FACTOR, factor * DECREASE_FACTOR)
+        elif waiting:
+            new_factor = min(1.0, factor + INCREASE_STEP)
+        conn.execute("UPDATE budget SET factor = ?, adjusted_at = ? WHERE id = 1", (new_factor, now))
+        if new_factor != factor and self.logger:
+            self.logger.info(f"Concurrency budget factor {factor:.2f} -> {new_factor:.2f} "
+                             f"(memory in use {memory_used:.0%}, load/core {load_per_core:.2f}, {waiting} waiting).")
+        return new_factor
+
+    def _has_capacity(self, conn, job):
+        if not super()._has_capacity(conn, job):
+            return False
+        factor = self._adjust_budget(conn, time.time())
+        running = conn.execute(
+            "SELECT COALESCE(SUM(r.memory_bytes), 0), COALESCE(SUM(r.cores), 0), COALESCE(SUM(r.disk_bytes), 0), COUNT(j.job_id) "
+            "FROM jobs j LEFT JOIN job_resources r ON r.job_id = j.job_id WHERE j.state = 'running'"
+        ).fetchone()
+        used_memory, used_cores, reserved_disk, running_count = running
+        if running_count == 0:
+            # Never leave the host idle because a single job is larger than the budget.
+            return True
+        wanted = conn.execute("SELECT memory_bytes, cores, disk_bytes FROM job_resources WHERE job_id = ?", (job['job_id'],)).fetchone()
+        if wanted is None:
+            return True
+        memory, cores, disk = wanted
+        # Running jobs may not have written their scratch data yet, so keep their share reserved.
+        free_disk = shutil.disk_usage(self.scratch_dir).free - reserved_disk
+        return (used_memory + memory <= factor * self.memory_budget_bytes
+                and used_cores + cores <= factor * self.cpu_budget
+                and disk <= free_disk)
+
+    def budget_snapshot(self):
+        with self._connect() as conn:
+            factor = conn.execute("SELECT factor FROM budget WHERE id = 1").fetchone()[0]
+            used = conn.execute(
+                "SELECT COALESCE(SUM(r.memory_bytes), 0), COALESCE(SUM(r.cores), 0), COALESCE(SUM(r.disk_bytes), 0) "
+                "FROM jobs j JOIN job_resources r ON r.job_id = j.job_id WHERE j.state = 'running'"
+            ).fetchone()
+        return {
+            'factor': round(factor, 3),
+            'memory_budget_bytes': int(factor * self.memory_budget_bytes),
+            'cpu_budget': round(factor * self.cpu_budget, 2),
+            'memory_reserved_bytes': used[0],
+            'cores_reserved': round(used[1], 2),
+            'disk_reserved_bytes': used[2],
+        }
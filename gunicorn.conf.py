@@ -0,0 +1,37 @@
+# gunicorn.conf.py
+# --- Gunicorn settings: build the app once in the master, then fork warm workers ---
+
+import os
+
+worker_class = 'gevent'
+bind = '0.0.0.0:8080'
+
+# Import app.py (config, JWKS, static assets, Pillow) in the master so every
+# worker inherits it copy-on-write instead of repeating the work.
+preload_app = True
+
+if worker_class == 'gevent':
+    # The preloaded app opens sockets (JWKS fetch) before workers would normally
+    # patch the stdlib, so patch in the master first.
+    from gevent import monkey
+    monkey.patch_all()
+
+# Job concurrency is governed by the scheduler's resource budget, not the worker
+# count, so default to one worker per core the container may actually use
+# (os.cpu_count() would report the host's cores and ignore a CPU limit).
+from concurrency_controller import available_cores
+workers = int(os.environ.get('GUNICORN_WORKERS', available_cores()))
+
+
+def when_ready(server):
+    server.log.info("Master is ready; the app was preloaded and workers will be forked from it.")
+
+
+def pre_fork(server, worker):
+    # Keep the GC from touching (and un-sharing) pages inherited from the master.
+    from warmup import freeze_heap
+    freeze_heap()
+
+
+def post_fork(server, worker):
+    server.log.info(f"Worker {worker.pid} forked from the warm master.")
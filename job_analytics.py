@@ -0,0 +1,334 @@
+# job_analytics.py
+# --- Historical per-job metrics for capacity planning ---
+
+import os
+import math
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import resource
+import threading
+
+RETENTION_SECONDS = 180 * 24 * 60 * 60
+PRUNE_INTERVAL = 60 * 60
+PERCENTILES = (50, 90, 95, 99)
+RSS_SAMPLE_INTERVAL = 0.5  # seconds between RSS samples while a job runs
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_runs (
+    job_id TEXT NOT NULL,
+    attempt_started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    sub TEXT,
+    outcome TEXT NOT NULL,
+    resumed INTEGER NOT NULL,
+    engine_type TEXT,
+    scorm_type TEXT,
+    options TEXT NOT NULL,
+    input_bytes INTEGER,
+    uncompressed_bytes INTEGER,
+    output_bytes INTEGER,
+    entries INTEGER,
+    duration_s REAL NOT NULL,
+    queue_wait_s REAL,
+    step_durations TEXT NOT NULL,
+    rss_growth_bytes INTEGER,
+    cache_hits INTEGER,
+    cache_misses INTEGER,
+    PRIMARY KEY (job_id, attempt_started_at)
+);
+CREATE INDEX IF NOT EXISTS job_runs_finished_at ON job_runs (finished_at);
+"""
+
+_COLUMNS = (
+    'job_id', 'attempt_started_at', 'finished_at', 'sub', 'outcome', 'resumed', 'engine_type', 'scorm_type',
+    'options', 'input_bytes', 'uncompressed_bytes', 'output_bytes', 'entries', 'duration_s', 'queue_wait_s',
+    'step_durations', 'rss_growth_bytes', 'cache_hits', 'cache_misses',
+)
+
+
+def current_rss_bytes():
+    """Resident set size of this process; falls back to the lifetime peak where /proc is unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class JobMemoryTracker:
+    """
+    How much one job attempt grows its worker's RSS: the peak, sampled while it
+    runs, minus the RSS when it started. A worker's concurrent jobs (gevent)
+    share one heap that can't be split between them, so an attempt that
+    overlapped another in the same process reports no growth rather than one
+    that includes the other job's memory.
+    """
+
+    _active = set()
+    _lock = threading.Lock()
+
+    def __init__(self, sample_interval=RSS_SAMPLE_INTERVAL, clock=time.monotonic):
+        self.sample_interval = sample_interval
+        self.clock = clock
+        self.shared = False
+        self.start_rss = self.peak_rss = None
+        self._last_sample_at = None
+
+    def start(self):
+        with self._lock:
+            if self._active:
+                self.shared = True
+                for other in self._active:
+                    other.shared = True
+            self._active.add(self)
+        self.start_rss = self.peak_rss = current_rss_bytes()
+        self._last_sample_at = self.clock()
+
+    def sample(self, force=False):
+        """Updates the peak; cheap to call per item, as it reads RSS at most once per sample_interval."""
+        if self.start_rss is None:
+            return
+        now = self.clock()
+        if force or now - self._last_sample_at >= self.sample_interval:
+            self._last_sample_at = now
+            self.peak_rss = max(self.peak_rss, current_rss_bytes())
+
+    def finish(self):
+        """Stops tracking; returns the RSS growth in bytes, or None if it can't be attributed to this attempt."""
+        if self.start_rss is None:
+            return None
+        self.sample(force=True)
+        with self._lock:
+            self._active.discard(self)
+        return None if self.shared else self.peak_rss - self.start_rss
+
+
+def parse_duration(value, default):
+    """Parses '90', '30m', '24h' or '7d' into seconds; raises ValueError for anything else, including nan and inf."""
+    if not value:
+        return default
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    value = value.strip().lower()
+    if value[-1] in units:
+        seconds = float(value[:-1]) * units[value[-1]]
+    else:
+        seconds = float(value)
+    if not math.isfinite(seconds):
+        raise ValueError(f"Not a finite duration: {value!r}")
+    return seconds
+
+
+def percentile(sorted_values, pct):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return round(sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low), 3)
+
+
+def _distribution(values, scale=1.0):
+    values = sorted(v / scale for v in values if v is not None)
+    if not values:
+        return None
+    summary = {f'p{p}': percentile(values, p) for p in PERCENTILES}
+    summary['max'] = round(values[-1], 3)
+    return summary
+
+
+class JobAnalytics:
+    """
+    One row per job attempt in a SQLite (WAL) database. `record()` only puts
+    the row on a queue; a background thread in each process writes rows in
+    batches, so a slow disk never holds up a progress stream.
+    """
+
+    def __init__(self, db_path, logger=None, retention_seconds=RETENTION_SECONDS):
+        self.db_path = db_path
+        self.logger = logger
+        self.retention_seconds = retention_seconds
+        self._queue = queue.Queue()
+        self._writer = None
+        self._writer_pid = None
+        self._last_prune = 0.0
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(job_runs)")}
+            if 'rss_growth_bytes' not in columns:
+                # Older databases only have the worker-wide peak_rss_bytes, which is no longer written.
+                conn.execute("ALTER TABLE job_runs ADD COLUMN rss_growth_bytes INTEGER")
+        finally:
+            conn.close()
+        atexit.register(self.flush)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    # --- Writing ---
+    def record(self, row):
+        """Queues a job row (a dict keyed by column name) for the background writer."""
+        row = dict(row)
+        row['options'] = json.dumps(row.get('options') or {}, sort_keys=True)
+        row['step_durations'] = json.dumps(row.get('step_durations') or {})
+        self._queue.put(tuple(row.get(column) for column in _COLUMNS))
+        self._ensure_writer()
+
+    def _ensure_writer(self):
+        # Threads do not survive fork, so each worker starts its own writer on first use.
+        if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+            return
+        self._writer_pid = os.getpid()
+        self._writer = threading.Thread(target=self._run_writer, name='job-analytics-writer', daemon=True)
+        self._writer.start()
+
+    def _run_writer(self):
+        while True:
+            rows = [self._queue.get()]
+            while True:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(rows)
+
+    def _write(self, rows):
+        placeholders = ', '.join('?' for _ in _COLUMNS)
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany(f"INSERT OR REPLACE INTO job_runs ({', '.join(_COLUMNS)}) VALUES ({placeholders})", rows)
+                    now = time.time()
+                    if now - self._last_prune > PRUNE_INTERVAL:
+                        self._last_prune = now
+                        conn.execute("DELETE FROM job_runs WHERE finished_at < ?", (now - self.retention_seconds,))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            # Analytics are best-effort; losing a row must never affect a job.
+            if self.logger:
+                self.logger.error(f"Could not write {len(rows)} job analytics row(s): {e}")
+
+    def flush(self):
+        """Writes anything still queued (called at exit)."""
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if rows:
+            self._write(rows)
+
+    # --- Querying ---
+    def similar_runs(self, uncompressed_bytes, engine_type=None, window_seconds=30 * 86400, limit=200):
+        """
+        RSS growth and duration of recent completed jobs within a factor of two
+        of `uncompressed_bytes`. Used to predict a new job's cost.
+        """
+        since = time.time() - window_seconds
+        query = ("SELECT rss_growth_bytes, duration_s FROM job_runs WHERE outcome = 'done' AND finished_at >= ? "
+                 "AND uncompressed_bytes BETWEEN ? AND ?")
+        args = [since, uncompressed_bytes / 2, uncompressed_bytes * 2]
+        if engine_type:
+            query += " AND engine_type = ?"
+            args.append(engine_type)
+        conn = self._connect()
+        try:
+            runs = conn.execute(query + " ORDER BY finished_at DESC LIMIT ?", args + [limit]).fetchall()
+        finally:
+            conn.close()
+        return {
+            'rss_growth_bytes': sorted(r[0] for r in runs if r[0] is not None),
+            'duration_s': sorted(r[1] for r in runs),
+        }
+
+    def summary(self, window_seconds, bucket_seconds, engine_type=None, min_bytes=None, max_bytes=None, now=None):
+        """
+        Duration, throughput, memory and queueing percentiles for jobs finished
+        in the last `window_seconds`, overall, per engine type and per step,
+        plus a trend with one bucket per `bucket_seconds`.
+        """
+        now = time.time() if now is None else now
+        since = now - window_seconds
+        query = "SELECT * FROM job_runs WHERE finished_at >= ?"
+        args = [since]
+        if engine_type:
+            query += " AND engine_type = ?"
+            args.append(engine_type)
+        if min_bytes is not None:
+            query += " AND uncompressed_bytes >= ?"
+            args.append(min_bytes)
+        if max_bytes is not None:
+            query += " AND uncompressed_bytes <= ?"
+            args.append(max_bytes)
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = [dict(r) for r in conn.execute(query + " ORDER BY finished_at", args)]
+        finally:
+            conn.close()
+
+        by_engine = {}
+        for row in rows:
+            by_engine.setdefault(row['engine_type'] or 'unknown', []).append(row)
+        step_times = {}
+        for row in rows:
+            for step, seconds in json.loads(row['step_durations']).items():
+                step_times.setdefault(step, []).append(seconds)
+
+        bucket_count = max(1, int(-(-window_seconds // bucket_seconds)))
+        buckets = [[] for _ in range(bucket_count)]
+        for row in rows:
+            index = min(bucket_count - 1, int((row['finished_at'] - since) // bucket_seconds))
+            buckets[index].append(row)
+
+        return {
+            'window_seconds': window_seconds,
+            'bucket_seconds': bucket_seconds,
+            'filters': {'engine_type': engine_type, 'min_bytes': min_bytes, 'max_bytes': max_bytes},
+            'overall': self._aggregate(rows),
+            'by_engine': {engine: self._aggregate(engine_rows) for engine, engine_rows in sorted(by_engine.items())},
+            'steps': {step: _distribution(values) for step, values in sorted(step_times.items())},
+            'trend': [
+                dict(self._aggregate(bucket_rows, detailed=False), start=since + i * bucket_seconds,
+                     # Average number of jobs in flight: a direct read on workers/cores needed.
+                     avg_concurrency=round(sum(r['duration_s'] for r in bucket_rows) / bucket_seconds, 3))
+                for i, bucket_rows in enumerate(buckets)
+            ],
+        }
+
+    @staticmethod
+    def _aggregate(rows, detailed=True):
+        completed = [r for r in rows if r['outcome'] == 'done']
+        hits = sum(r['cache_hits'] or 0 for r in completed)
+        lookups = hits + sum(r['cache_misses'] or 0 for r in completed)
+        busy_seconds = sum(r['duration_s'] for r in completed)
+        total_bytes = sum(r['uncompressed_bytes'] or 0 for r in completed)
+        result = {
+            'jobs': len(rows),
+            'done': len(completed),
+            'failed': sum(1 for r in rows if r['outcome'] == 'failed'),
+            'interrupted': sum(1 for r in rows if r['outcome'] == 'interrupted'),
+            'duration_s': _distribution([r['duration_s'] for r in completed]),
+            'mb_processed': round(total_bytes / 1e6, 3),
+            'throughput_mb_s': round(total_bytes / 1e6 / busy_seconds, 3) if busy_seconds else None,
+        }
+        if detailed:
+            result.update({
+                'job_throughput_mb_s': _distribution([
+                    (r['uncompressed_bytes'] or 0) / 1e6 / r['duration_s'] for r in completed if r['duration_s']
+                ]),
+                'input_mb': _distribution([r['input_bytes'] for r in completed], scale=1e6),
+                'queue_wait_s': _distribution([r['queue_wait_s'] for r in rows]),
+                'rss_growth_mb': _distribution([r['rss_growth_bytes'] for r in rows], scale=1e6),
+                'cache_hit_rate': round(hits / lookups, 4) if lookups else None,
+            })
+        return result
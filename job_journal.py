@@ -0,0 +1,421 @@
+# job_journal.py
+# --- Durable per-job journal so interrupted jobs resume instead of restarting ---
+
+import os
+import json
+import time
+import asyncio
+import fcntl
+import shutil
+
+from progress import HEARTBEAT_FRAME, HEARTBEAT_INTERVAL
+
+TERMINAL_STATES = ('done', 'failed')
+JOURNAL_RETENTION_SECONDS = 24 * 60 * 60
+PRUNE_INTERVAL_SECONDS = 10 * 60
+POLL_INTERVAL = 0.5          # seconds between frame-log reads while a job is producing frames
+MAX_POLL_INTERVAL = 2.0      # longest gap between reads once it goes quiet (queued, or in a long step)
+
+_last_pruned_at = 0.0
+
+
+def _still_dispatched(dispatched):
+    """True while a run handed off by this process (executor future or Process) has not finished."""
+    if dispatched is None:
+        return False
+    if hasattr(dispatched, 'is_alive'):
+        return dispatched.is_alive()
+    return not dispatched.done()
+
+
+def _append_json_line(path, record, durable):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n')
+        f.flush()
+        if durable:
+            os.fsync(f.fileno())
+
+
+def _read_json_lines(path, offset=0):
+    """Returns (records, new_offset); a torn trailing line from a crash is left unread."""
+    records = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                offset += len(line.encode('utf-8'))
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records, offset
+
+
+class JobJournal:
+    """
+    Append-only record of one job: its parameters, each completed step with the
+    state later steps need, every progress frame sent, and the terminal outcome.
+
+    Files live in `<root>/<job_id>/`. The job's working copy of the package is
+    kept in `work/` so a resumed job continues from the last completed step.
+    Whoever runs the job holds an flock on `lock`; the kernel drops it if the
+    worker dies, which is how an orphaned job is recognised.
+    """
+
+    def __init__(self, root, job_id):
+        self.job_id = job_id
+        self.dir = os.path.join(root, job_id)
+        self.work_dir = os.path.join(self.dir, 'work')
+        self.logo_path = os.path.join(self.dir, 'logo')
+        self.license_key_path = os.path.join(self.dir, 'license_key')
+        self.records_path = os.path.join(self.dir, 'journal.jsonl')
+        self.frames_path = os.path.join(self.dir, 'frames.jsonl')
+        self.lock_path = os.path.join(self.dir, 'lock')
+        self.owner = None
+        self.params = {}
+        self.created_at = None
+        self.completed_steps = []
+        self.ctx = {}
+        self.state = 'running'
+        self.result = None
+        self.last_seq = 0
+        self._records_offset = 0
+        self._lock_fd = None
+
+    # --- Creation and loading ---
+    @classmethod
+    def create(cls, root, job_id, owner, params, logo_bytes=None, license_key=None):
+        """
+        `params` are journalled as is, so secrets go in separately: the license
+        key is kept in its own owner-only file, which discard_work removes once
+        the job reaches a terminal state.
+        """
+        journal = cls(root, job_id)
+        os.makedirs(journal.dir, mode=0o700)
+        if logo_bytes is not None:
+            with open(journal.logo_path, 'wb') as f:
+                f.write(logo_bytes)
+        if license_key:
+            fd = os.open(journal.license_key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(license_key)
+        journal.owner = owner
+        journal.params = params
+        journal.created_at = time.time()
+        _append_json_line(journal.records_path, {
+            'type': 'created', 'owner': owner, 'params': params, 'at': journal.created_at,
+        }, durable=True)
+        return journal
+
+    @classmethod
+    def load(cls, root, job_id):
+        journal = cls(root, job_id)
+        if not os.path.exists(journal.records_path):
+            return None
+        journal.refresh()
+        frames, _ = _read_json_lines(journal.frames_path)
+        if frames:
+            journal.last_seq = frames[-1]['seq']
+        return journal
+
+    def refresh(self):
+        """Applies any journal records written since the last read."""
+        records, self._records_offset = _read_json_lines(self.records_path, self._records_offset)
+        for record in records:
+            if record['type'] == 'created':
+                self.owner = record['owner']
+                self.params = record['params']
+                self.created_at = record['at']
+            elif record['type'] == 'step':
+                self.completed_steps.append(record['name'])
+                self.ctx = record['ctx']
+            elif record['type'] == 'terminal':
+                self.state = record['state']
+                self.result = record.get('result')
+
+    @property
+    def is_terminal(self):
+        return self.state in TERMINAL_STATES
+
+    def read_logo(self):
+        if not os.path.exists(self.logo_path):
+            return None
+        with open(self.logo_path, 'rb') as f:
+            return f.read()
+
+    def read_license_key(self):
+        if not os.path.exists(self.license_key_path):
+            return None
+        with open(self.license_key_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    # --- Ownership ---
+    def acquire(self):
+        """Takes the run lock without blocking; returns False if another worker holds it."""
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def is_running(self):
+        """True while some worker (possibly this one) holds the run lock."""
+        if self._lock_fd is not None:
+            return True
+        if not self.acquire():
+            return True
+        self.release()
+        return False
+
+    def release(self):
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    # --- Checkpoints ---
+    def complete_step(self, name, ctx):
+        self.completed_steps.append(name)
+        self.ctx = dict(ctx)
+        _append_json_line(self.records_path, {'type': 'step', 'name': name, 'ctx': self.ctx, 'at': time.time()}, durable=True)
+
+    def finish(self, state, result=None):
+        self.state = state
+        self.result = result
+        _append_json_line(self.records_path, {'type': 'terminal', 'state': state, 'result': result, 'at': time.time()}, durable=True)
+
+    # --- Progress frames (the ProgressEncoder channel interface) ---
+    def record(self, seq, frame):
+        self.last_seq = seq
+        # Frames are a convenience for reconnecting clients; skip fsync on the hot path.
+        _append_json_line(self.frames_path, {'seq': seq, 'frame': frame}, durable=False)
+
+    def frames_after(self, last_seq):
+        frames, _ = _read_json_lines(self.frames_path)
+        return [(f['seq'], f['frame']) for f in frames if f['seq'] > last_seq]
+
+    def last_progress_payload(self):
+        """The JSON body of the most recent `progress` frame, used to restore an encoder."""
+        for _, frame in reversed(self.frames_after(0)):
+            if '\nevent: progress\n' in f'\n{frame}':
+                data = frame.split('\ndata: ', 1)[1]
+                return json.loads(data)
+        return None
+
+    def _poll_frames(self, offset, last_seq):
+        """One tailing pass: returns (frames after last_seq, new offset, whether the job was terminal before reading)."""
+        self.refresh()
+        terminal = self.is_terminal
+        records, offset = _read_json_lines(self.frames_path, offset)
+        return [(f['seq'], f['frame']) for f in records if f['seq'] > last_seq], offset, terminal
+
+    def _runner_gone(self):
+        """True once nobody runs the job and it did not finish (re-checked to close the race with a final write)."""
+        if self.is_running():
+            return False
+        self.refresh()
+        return not self.is_terminal
+
+    def follow(self, last_seq=0, poll_interval=POLL_INTERVAL, heartbeat_interval=HEARTBEAT_INTERVAL, dispatched=None):
+        """
+        Tails the frame log after `last_seq` until the job reaches a terminal state.
+        Ends early if the runner disappears, so the client reconnects and resumes it.
+        `dispatched` is as for afollow. Polls back off while the job is quiet.
+        """
+        offset = 0
+        interval = poll_interval
+        last_write = time.monotonic()
+        while True:
+            frames, offset, terminal = self._poll_frames(offset, last_seq)
+            for last_seq, frame in frames:
+                yield frame
+            now = time.monotonic()
+            if frames:
+                last_write = now
+                interval = poll_interval
+            elif terminal:
+                return
+            elif not _still_dispatched(dispatched) and self._runner_gone():
+                return
+            elif self.is_terminal:
+                continue  # the runner just finished; drain its final frames
+            else:
+                interval = min(2 * interval, MAX_POLL_INTERVAL)
+                if now - last_write >= heartbeat_interval:
+                    last_write = now
+                    yield HEARTBEAT_FRAME
+            time.sleep(interval)
+
+    async def afollow(self, last_seq=0, poll_interval=POLL_INTERVAL, heartbeat_interval=HEARTBEAT_INTERVAL, dispatched=None, executor=None):
+        """
+        asyncio version of follow() for the ASGI front-end. `dispatched` is the
+        executor future (or Process) of a run handed off by this process; until
+        it completes the job counts as running, even before the run lock is taken.
+
+        All streams on one job share a single _JobTailer, which reads the journal
+        on `executor` (the loop's default executor if None), never on the loop.
+        """
+        tailer = _JobTailer.subscribe(self, dispatched, executor, poll_interval)
+        try:
+            seen = 0
+            last_write = time.monotonic()
+            while True:
+                wakeup = tailer.wakeup
+                frames, seen = tailer.frames[seen:], len(tailer.frames)
+                for seq, frame in frames:
+                    if seq > last_seq:
+                        last_seq = seq
+                        last_write = time.monotonic()
+                        yield frame
+                if tailer.error is not None:
+                    raise tailer.error
+                if tailer.ended and seen == len(tailer.frames):
+                    return
+                if seen < len(tailer.frames):
+                    continue
+                try:
+                    await asyncio.wait_for(wakeup.wait(), max(0.0, heartbeat_interval - (time.monotonic() - last_write)))
+                except asyncio.TimeoutError:
+                    last_write = time.monotonic()
+                    yield HEARTBEAT_FRAME
+        finally:
+            tailer.unsubscribe()
+
+    # --- Cleanup ---
+    def discard_work(self):
+        if os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+        if os.path.exists(self.logo_path):
+            os.remove(self.logo_path)
+        if os.path.exists(self.license_key_path):
+            os.remove(self.license_key_path)
+
+
+class _JobTailer:
+    """
+    Tails one job's journal for every afollow() stream on it in this process,
+    so N clients watching a job cost one poll, not N. Polls (and the run-lock
+    check once the job goes quiet) run on an executor, and back off from
+    `poll_interval` to MAX_POLL_INTERVAL while nothing new arrives.
+    """
+
+    _by_job = {}
+
+    def __init__(self, journal, dispatched, executor, poll_interval):
+        self.journal = journal
+        self.dispatched = dispatched
+        self.executor = executor
+        self.poll_interval = poll_interval
+        self.frames = []
+        self.ended = False
+        self.error = None
+        self.subscribers = 0
+        self.wakeup = asyncio.Event()
+        self._task = None
+
+    @classmethod
+    def subscribe(cls, journal, dispatched=None, executor=None, poll_interval=POLL_INTERVAL):
+        tailer = cls._by_job.get(journal.records_path)
+        if tailer is None:
+            tailer = cls._by_job[journal.records_path] = cls(journal, dispatched, executor, poll_interval)
+            tailer._task = asyncio.ensure_future(tailer._run())
+        elif dispatched is not None:
+            tailer.dispatched = dispatched
+        tailer.subscribers += 1
+        return tailer
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.ended:
+            self._task.cancel()
+            self._end()
+
+    def _end(self):
+        self.ended = True
+        if self._by_job.get(self.journal.records_path) is self:
+            del self._by_job[self.journal.records_path]
+        self._notify()
+
+    def _notify(self):
+        self.wakeup.set()
+        self.wakeup = asyncio.Event()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        offset, last_seq = 0, 0
+        interval = self.poll_interval
+        try:
+            while True:
+                frames, offset, terminal = await loop.run_in_executor(self.executor, self.journal._poll_frames, offset, last_seq)
+                if frames:
+                    last_seq = frames[-1][0]
+                    self.frames.extend(frames)
+                    self._notify()
+                    interval = self.poll_interval
+                elif terminal:
+                    return
+                elif not _still_dispatched(self.dispatched) and await loop.run_in_executor(self.executor, self.journal._runner_gone):
+                    return
+                elif self.journal.is_terminal:
+                    continue  # the runner just finished; drain its final frames
+                else:
+                    interval = min(2 * interval, MAX_POLL_INTERVAL)
+                await asyncio.sleep(interval)
+        except Exception as e:
+            self.error = e
+        finally:
+            if not self.ended:
+                self._end()
+
+
+def _created_at(records_path):
+    """Creation time from a journal's first record, without reading the rest of it."""
+    try:
+        with open(records_path, 'r', encoding='utf-8') as f:
+            record = json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+    return record.get('at') if record.get('type') == 'created' else None
+
+
+def prune_journals(root, logger, max_age=JOURNAL_RETENTION_SECONDS, interval=PRUNE_INTERVAL_SECONDS):
+    """
+    Deletes journals (and any uploads they still hold) older than `max_age` that
+    nobody is running. Called per request, so it does nothing if this process
+    already pruned within `interval` (pass 0 to force), and journals are only
+    opened once their first line shows they are old enough.
+    """
+    global _last_pruned_at
+    now = time.time()
+    if now - _last_pruned_at < interval:
+        return
+    _last_pruned_at = now
+    cutoff = now - max_age
+    for entry in os.scandir(root):
+        if not entry.is_dir():
+            continue
+        created_at = _created_at(os.path.join(entry.path, 'journal.jsonl'))
+        if created_at is None or created_at > cutoff:
+            continue
+        journal = JobJournal(root, entry.name)
+        journal.refresh()
+        if not journal.acquire():
+            continue
+        try:
+            upload_dir = os.path.dirname(journal.params.get('zip_path') or '')
+            # Uploads are kept in a per-job folder until the job reaches a terminal state.
+            if os.path.basename(upload_dir) == journal.job_id:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+            shutil.rmtree(journal.dir)
+            logger.info(f"Pruned journal for job {journal.job_id} ({journal.state}).")
+        except OSError as e:
+            logger.error(f"Could not prune journal for job {journal.job_id}: {e}")
+        finally:
+            journal.release()
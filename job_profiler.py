@@ -0,0 +1,120 @@
+# job_profiler.py
+# --- Operator-only profiling of a single processing job ---
+
+import os
+import cProfile
+import pstats
+import tracemalloc
+from collections import Counter
+
+PROFILE_ARTIFACTS = {
+    'profile.pstats': 'application/octet-stream',
+    'stacks.collapsed': 'text/plain',
+    'tracemalloc.txt': 'text/plain',
+    'tracemalloc.snapshot': 'application/octet-stream',
+}
+
+# Call-graph edges below this share of time are not expanded into stacks.
+_MIN_STACK_SECONDS = 0.0001
+_MAX_STACK_DEPTH = 64
+
+
+def _frame_label(func):
+    filename, lineno, name = func
+    if filename == '~':
+        return name
+    return f"{os.path.basename(filename)}:{lineno}:{name}"
+
+
+def _collapsed_stacks(stats):
+    """
+    Folds a cProfile call graph into flamegraph.pl-style collapsed stacks
+    ("a;b;c <microseconds>"). cProfile only records caller/callee edges, so
+    time on shared callees is split in proportion to each edge's cumulative time.
+    """
+    stats.calc_callees()
+    folded = Counter()
+
+    def walk(func, stack, share, depth):
+        _, _, tottime, cumtime, _ = stats.stats[func]
+        fraction = share / cumtime if cumtime else 0.0
+        folded[';'.join(stack)] += tottime * fraction
+        if depth >= _MAX_STACK_DEPTH:
+            return
+        for callee, edge in stats.all_callees.get(func, {}).items():
+            edge_share = edge[3] * fraction
+            if edge_share < _MIN_STACK_SECONDS or _frame_label(callee) in stack:
+                continue
+            walk(callee, stack + [_frame_label(callee)], edge_share, depth + 1)
+
+    for func, (_, _, _, cumtime, callers) in stats.stats.items():
+        if not callers:
+            walk(func, [_frame_label(func)], cumtime, 0)
+
+    return ''.join(
+        f"{stack} {int(seconds * 1_000_000)}\n"
+        for stack, seconds in sorted(folded.items())
+        if int(seconds * 1_000_000) > 0
+    )
+
+
+def _resume_job(stream):
+    # The root of every profiled stack. Calling `next` directly would leave no
+    # root: the job's nested generators call `next` too, so it always has callers.
+    return next(stream)
+
+
+def profile_stream(stream, artifact_dir, logger):
+    """
+    Wraps an SSE generator so every resume of it runs under cProfile, with
+    tracemalloc snapshots taken at the start and the end of the job.
+
+    The profiler is only enabled while the job itself is executing; time spent
+    writing frames to the client is excluded. Artifacts land in `artifact_dir`.
+    """
+    os.makedirs(artifact_dir, exist_ok=True)
+    profiler = cProfile.Profile()
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(25)
+    first_snapshot = tracemalloc.take_snapshot()
+    try:
+        while True:
+            profiler.enable()
+            try:
+                item = _resume_job(stream)
+            except StopIteration:
+                return
+            finally:
+                profiler.disable()
+            yield item
+    finally:
+        try:
+            last_snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            _write_artifacts(profiler, first_snapshot, last_snapshot, peak, artifact_dir)
+            logger.info(f"Profiling artifacts written to {artifact_dir}")
+        except Exception as e:
+            logger.error(f"Could not write profiling artifacts to {artifact_dir}: {e}", exc_info=True)
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
+
+
+def _write_artifacts(profiler, first_snapshot, last_snapshot, peak, artifact_dir):
+    profiler.dump_stats(os.path.join(artifact_dir, 'profile.pstats'))
+    stats = pstats.Stats(profiler)
+    with open(os.path.join(artifact_dir, 'stacks.collapsed'), 'w', encoding='utf-8') as f:
+        f.write(_collapsed_stacks(stats))
+
+    last_snapshot.dump(os.path.join(artifact_dir, 'tracemalloc.snapshot'))
+    with open(os.path.join(artifact_dir, 'tracemalloc.txt'), 'w', encoding='utf-8') as f:
+        f.write(f"Peak traced memory: {peak / (1024 * 1024):.1f} MiB\n\n")
+        f.write("Top allocations by line (growth during the job):\n")
+        for stat in last_snapshot.compare_to(first_snapshot, 'lineno')[:50]:
+            f.write(f"{stat}\n")
+        f.write("\nTop allocations by traceback (live at end of job):\n")
+        for stat in last_snapshot.statistics('traceback')[:10]:
+            f.write(f"{stat}\n")
+            for line in stat.traceback.format():
+                f.write(f"    {line}\n")
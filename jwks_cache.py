@@ -0,0 +1,43 @@
+# jwks_cache.py
+# --- Process-wide cache of the Auth0 signing keys ---
+
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+
+class JWKSCache:
+    """
+    Fetches the JWKS document once and keeps it for `ttl` seconds, instead of
+    downloading it on every authenticated request. An unknown `kid` triggers an
+    early refresh (key rotation), at most once every `min_refresh_interval`.
+    """
+
+    def __init__(self, url, ttl=3600, min_refresh_interval=30, timeout=10):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+        keys = {key["kid"]: key for key in jwks["keys"]}
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        return keys
+
+    def get_key(self, kid):
+        """Returns the JWK for `kid`, or None if the issuer does not publish it."""
+        age = time.monotonic() - self._fetched_at
+        key = self._keys.get(kid)
+        if key is not None and age < self.ttl:
+            return key
+        if key is None and self._keys and age < self.min_refresh_interval:
+            return None
+        return self.refresh().get(kid)
@@ -5,10 +5,18 @@ import logging
 from logging.handlers import RotatingFileHandler
 import os
 
+FILE_HANDLER_NAME = 'scorm_processor_file'
+CONSOLE_HANDLER_NAME = 'scorm_processor_console'
+
 def setup_logging(app):
     """
     Configures a rotating file logger for the Flask application.
+    Safe to call again: every app built by create_app() shares the same named
+    logger, so the handlers are only added once.
     """
+    if any(h.get_name() == FILE_HANDLER_NAME for h in app.logger.handlers):
+        app.logger.setLevel(logging.INFO)
+        return
     # Create a logs directory if it doesn't exist
     log_dir = 'logs'
     if not os.path.exists(log_dir):
@@ -32,6 +40,7 @@ def setup_logging(app):
         '%(asctime)s - %(levelname)s - [in %(pathname)s:%(lineno)d] - %(message)s'
     )
     file_handler.setFormatter(log_formatter)
+    file_handler.set_name(FILE_HANDLER_NAME)
 
     # Set the logging level (e.g., INFO, DEBUG, ERROR)
     file_handler.setLevel(logging.INFO)
@@ -44,6 +53,7 @@ def setup_logging(app):
     # You can comment this out if you only want file-based logs
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(log_formatter)
+    console_handler.set_name(CONSOLE_HANDLER_NAME)
     app.logger.addHandler(console_handler)
 
     app.logger.info('Logging has been successfully configured.')
\ No newline at end of file
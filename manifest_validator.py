@@ -0,0 +1,164 @@
+# manifest_validator.py
+# --- Streaming validation of imsmanifest.xml references against the archive's entries ---
+
+import posixpath
+import time
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote, urlsplit
+
+XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+MAX_REPORTED_ISSUES = 200
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _attr(element, name):
+    """Reads an attribute whatever namespace prefix it was written with (e.g. adlcp:scormType)."""
+    for key, value in element.attrib.items():
+        if _local(key).lower() == name.lower():
+            return value
+    return None
+
+
+def _resolve(base, href):
+    """
+    Turns an href into an archive path, or None for references that are not
+    inside the package (absolute URLs, javascript:, fragments only).
+    """
+    parts = urlsplit(href.strip())
+    if parts.scheme or parts.netloc or not parts.path:
+        return None
+    path = posixpath.normpath(posixpath.join(base, unquote(parts.path)))
+    if path.startswith('../') or path == '..':
+        return None
+    return path.lstrip('/')
+
+
+class ManifestReport:
+    def __init__(self):
+        self.files_checked = 0
+        self.resources = 0
+        self.items = 0
+        self.errors = 0
+        self.warnings = 0
+        self.issues = []
+
+    def add(self, severity, code, message, **details):
+        if severity == 'error':
+            self.errors += 1
+        else:
+            self.warnings += 1
+        if len(self.issues) < MAX_REPORTED_ISSUES:
+            self.issues.append(dict(details, severity=severity, code=code, message=message))
+
+    def as_dict(self, elapsed_ms):
+        return {
+            'valid': self.errors == 0,
+            'errors': self.errors,
+            'warnings': self.warnings,
+            'files_checked': self.files_checked,
+            'resources': self.resources,
+            'items': self.items,
+            'elapsed_ms': elapsed_ms,
+            'issues': self.issues,
+            'truncated': self.errors + self.warnings > len(self.issues),
+        }
+
+
+def validate_manifest(manifest_file, entry_index):
+    """
+    Checks every <resource href> and <file href> against `entry_index` (a set
+    of archive paths) and the identifier / identifierref graph of the
+    manifest. The manifest is read with iterparse and elements are cleared as
+    soon as they are handled, so memory stays flat for very large manifests.
+    Returns a JSON-serialisable report dict.
+    """
+    started = time.monotonic()
+    report = ManifestReport()
+    lowercase_index = None
+
+    def check_path(path, href, code, **details):
+        nonlocal lowercase_index
+        report.files_checked += 1
+        if path in entry_index:
+            return
+        if lowercase_index is None:
+            lowercase_index = {name.lower(): name for name in entry_index}
+        near_miss = lowercase_index.get(path.lower())
+        if near_miss:
+            report.add('error', code, f"'{href}' does not match the case of '{near_miss}' in the package.", href=href, **details)
+        else:
+            report.add('error', code, f"'{href}' is referenced by the manifest but missing from the package.", href=href, **details)
+
+    identifiers = {}
+    resource_ids = set()
+    organization_ids = set()
+    references = []  # (kind, identifierref, owner identifier)
+    default_organization = None
+    base_stack = ['']
+    current_resource = None
+
+    try:
+        for event, element in ET.iterparse(manifest_file, events=('start', 'end')):
+            tag = _local(element.tag)
+            if event == 'start':
+                base = element.get(XML_BASE)
+                base_stack.append(posixpath.join(base_stack[-1], base) if base else base_stack[-1])
+                identifier = element.get('identifier')
+                if identifier and tag in ('manifest', 'organization', 'item', 'resource'):
+                    if identifier in identifiers:
+                        report.add('error', 'duplicate_identifier', f"Identifier '{identifier}' is used by more than one <{tag}>.", identifier=identifier)
+                    identifiers[identifier] = tag
+
+                if tag == 'organizations':
+                    default_organization = element.get('default')
+                elif tag == 'organization':
+                    organization_ids.add(identifier)
+                elif tag == 'item':
+                    report.items += 1
+                    ref = element.get('identifierref')
+                    if ref:
+                        references.append(('item', ref, identifier))
+                elif tag == 'resource':
+                    report.resources += 1
+                    current_resource = identifier
+                    resource_ids.add(identifier)
+                    href = element.get('href')
+                    scorm_type = _attr(element, 'scormType')
+                    if href:
+                        path = _resolve(base_stack[-1], href)
+                        if path is not None:
+                            check_path(path, href, 'missing_resource_href', resource=identifier)
+                    elif scorm_type and scorm_type.lower() == 'sco':
+                        report.add('error', 'sco_without_href', f"SCO resource '{identifier}' has no href.", resource=identifier)
+                elif tag == 'file' and current_resource is not None:
+                    href = element.get('href')
+                    path = _resolve(base_stack[-1], href) if href else None
+                    if path is not None:
+                        check_path(path, href, 'missing_file', resource=current_resource)
+                elif tag == 'dependency' and current_resource is not None:
+                    ref = element.get('identifierref')
+                    if ref:
+                        references.append(('dependency', ref, current_resource))
+            else:
+                base_stack.pop()
+                if tag == 'resource':
+                    current_resource = None
+                # Items nest, so only drop subtrees we are finished with.
+                if tag in ('resource', 'item', 'organization', 'file', 'dependency', 'metadata'):
+                    element.clear()
+    except ET.ParseError as e:
+        report.add('error', 'malformed_manifest', f"The manifest is not well-formed XML: {e}")
+        return report.as_dict(round((time.monotonic() - started) * 1000, 1))
+
+    for kind, ref, owner in references:
+        if ref not in resource_ids:
+            report.add('error', 'dangling_identifierref', f"<{kind}> '{owner}' points to unknown resource '{ref}'.", identifierref=ref, owner=owner)
+    if default_organization and default_organization not in organization_ids:
+        report.add('error', 'dangling_default_organization', f"Default organization '{default_organization}' is not defined.", identifierref=default_organization)
+    if report.resources == 0:
+        report.add('warning', 'no_resources', "The manifest declares no resources.")
+
+    return report.as_dict(round((time.monotonic() - started) * 1000, 1))
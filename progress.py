@@ -0,0 +1,162 @@
+# progress.py
+# --- Structured, coalesced SSE progress protocol with heartbeats and resume ---
+
+import json
+import time
+from collections import namedtuple
+
+# Yielded by processing steps alongside log lines. `processed` is a delta in
+# bytes; `total` (when set) replaces the job's estimated amount of work, and
+# `remaining` (when set) makes it what has been processed so far plus this much,
+# for steps that count a different kind of byte than the ones before them.
+ProgressUpdate = namedtuple('ProgressUpdate', ['processed', 'total', 'remaining'], defaults=(0, None, None))
+
+# Yielded by steps that have a structured result to report (e.g. validation).
+# Sent as its own SSE event in the JSON protocol; dropped in text compat mode,
+# where the step's log lines already describe it.
+ProgressEvent = namedtuple('ProgressEvent', ['event', 'payload'])
+
+COALESCE_WINDOW = 0.25       # seconds; log lines arriving within this window share one frame
+PERCENT_INTERVAL = 1.0       # seconds between frames that only carry a new percentage
+HEARTBEAT_INTERVAL = 15.0    # seconds of silence before a keep-alive comment is sent
+PROGRESS_UPDATE_INTERVAL = 5.0  # longest a long-running step should go without yielding a ProgressUpdate
+
+HEARTBEAT_FRAME = ': keep-alive\n\n'
+
+
+def _compact_json(payload):
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+
+
+class ProgressEncoder:
+    """
+    Turns the processing flow's log lines and ProgressUpdates into SSE frames.
+
+    In the default JSON protocol each frame carries an `id:` (for Last-Event-ID),
+    the current step id and name, percent complete and bytes processed, and all
+    log lines produced within COALESCE_WINDOW. With `compat=True` the original
+    one-`data:`-line-per-log-line format is produced instead.
+
+    Every frame is also handed to `channel.record(seq, frame)` (the job journal)
+    so reconnecting clients can replay what they missed.
+    """
+
+    def __init__(self, job_id, channel=None, compat=False, clock=time.monotonic):
+        self.job_id = job_id
+        self.channel = channel
+        self.compat = compat
+        self.clock = clock
+        self.seq = 0
+        self.step = 0
+        self.step_name = None
+        self.bytes_processed = 0
+        self.bytes_total = None
+        self.pending_lines = []
+        self.last_frame_at = None
+        self.last_percent_sent = None
+
+    # --- Frame construction ---
+    def _percent(self):
+        if not self.bytes_total:
+            return None
+        return round(min(99.9, 100.0 * self.bytes_processed / self.bytes_total), 1)
+
+    def _frame(self, event, payload):
+        self.seq += 1
+        self.last_frame_at = self.clock()
+        if self.compat:
+            data = payload if isinstance(payload, str) else _compact_json(payload)
+            frame = f'data: {data}\n\n' if event is None else f'event: {event}\ndata: {data}\n\n'
+        else:
+            frame = f'id: {self.seq}\nevent: {event}\ndata: {_compact_json(payload)}\n\n'
+        if self.channel is not None:
+            self.channel.record(self.seq, frame)
+        return frame
+
+    def _progress_payload(self, lines):
+        payload = {'job': self.job_id, 'step': self.step, 'step_name': self.step_name, 'bytes': self.bytes_processed}
+        if self.bytes_total:
+            payload['bytes_total'] = self.bytes_total
+            payload['percent'] = self._percent()
+        if lines:
+            payload['lines'] = lines
+        return payload
+
+    def _flush(self):
+        lines, self.pending_lines = self.pending_lines, []
+        if self.compat:
+            # Still one write per coalescing window, even in the legacy format.
+            yield ''.join(self._frame(None, line) for line in lines)
+            return
+        self.last_percent_sent = self._percent()
+        yield self._frame('progress', self._progress_payload(lines))
+
+    def _idle_for(self, seconds):
+        return self.last_frame_at is None or self.clock() - self.last_frame_at >= seconds
+
+    # --- Public API ---
+    def restore(self, seq, payload):
+        """Continues numbering and progress from a journal when a job is resumed."""
+        self.seq = seq
+        if payload:
+            self.step = payload.get('step', 0)
+            self.step_name = payload.get('step_name')
+            self.bytes_processed = payload.get('bytes', 0)
+            self.bytes_total = payload.get('bytes_total')
+
+    def start(self):
+        """Opening frame announcing the job id (JSON protocol only)."""
+        if not self.compat:
+            yield self._frame('job', {'job': self.job_id})
+
+    def feed(self, item):
+        """Consumes one item from the processing flow and yields zero or more frames."""
+        if isinstance(item, ProgressEvent):
+            if not self.compat:
+                if self.pending_lines:
+                    yield from self._flush()
+                yield self._frame(item.event, dict(item.payload, job=self.job_id, step=self.step))
+            return
+        if isinstance(item, ProgressUpdate):
+            self.bytes_processed += item.processed
+            if item.total is not None:
+                self.bytes_total = item.total
+            if item.remaining is not None:
+                self.bytes_total = self.bytes_processed + item.remaining
+        else:
+            if item.startswith('[STEP]'):
+                # Keep each step's lines in frames tagged with that step.
+                if self.pending_lines:
+                    yield from self._flush()
+                self.step += 1
+                self.step_name = item[len('[STEP]'):].strip()
+            self.pending_lines.append(item)
+
+        if self.pending_lines and self._idle_for(COALESCE_WINDOW):
+            yield from self._flush()
+        elif not self.compat and self._percent() != self.last_percent_sent and self._idle_for(PERCENT_INTERVAL):
+            yield from self._flush()
+        elif self._idle_for(HEARTBEAT_INTERVAL):
+            self.last_frame_at = self.clock()
+            yield HEARTBEAT_FRAME
+
+    def done(self, payload):
+        """Flushes pending lines and emits the terminal `done` event."""
+        if self.pending_lines:
+            yield from self._flush()
+        if not self.compat:
+            payload = dict(payload, job=self.job_id, percent=100.0, bytes=self.bytes_processed)
+        yield self._frame('done', payload)
+        if self.channel is not None:
+            self.channel.finish('done', payload)
+
+    def error(self, message):
+        """Flushes pending lines and emits the terminal `error` event."""
+        if self.pending_lines:
+            yield from self._flush()
+        payload = {'message': message}
+        if not self.compat:
+            payload['job'] = self.job_id
+        yield self._frame('error', payload)
+        if self.channel is not None:
+            self.channel.finish('failed', payload)
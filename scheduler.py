@@ -0,0 +1,194 @@
+# scheduler.py
+# --- Fair-share scheduling of processing jobs across users ---
+
+import os
+import time
+import sqlite3
+from contextlib import contextmanager
+
+STALE_AFTER_SECONDS = 60
+HEARTBEAT_INTERVAL = 10
+DEFAULT_BYTES_PER_SECOND = 20 * 1024 * 1024
+ETA_GRANULARITY_SECONDS = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    sub TEXT NOT NULL,
+    cost INTEGER NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    start_tag REAL NOT NULL,
+    finish_tag REAL NOT NULL,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    sub TEXT PRIMARY KEY,
+    last_finish_tag REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS clock (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    virtual_time REAL NOT NULL,
+    bytes_per_second REAL NOT NULL
+);
+"""
+
+
+class FairShareScheduler:
+    """
+    Weighted fair queuing of jobs across JWT subjects, shared by all workers
+    through a small SQLite (WAL) database.
+
+    Each job gets a virtual finish tag of max(virtual time, the user's last
+    finish tag) + cost / weight, so a user who queues fifty courses only gets
+    ahead of a colleague's single job for as long as their share allows. Jobs
+    in the priority lane go first. Jobs start in finish-tag order, subject to
+    a global limit and a per-user limit on running jobs.
+    """
+
+    def __init__(self, db_path, max_running=3, per_user_limit=2, user_weights=None, logger=None):
+        self.db_path = db_path
+        self.max_running = max_running
+        self.per_user_limit = per_user_limit
+        self.user_weights = user_weights or {}
+        self.logger = logger
+        self._last_heartbeat = {}
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            conn.execute("INSERT OR IGNORE INTO clock (id, virtual_time, bytes_per_second) VALUES (1, 0, ?)", (DEFAULT_BYTES_PER_SECOND,))
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    # --- Queue operations ---
+    def enqueue(self, job_id, sub, cost, priority=False, resources=None):
+        """Queues a job. `resources` (its predicted resource use) is only used by capacity-aware subclasses."""
+        now = time.time()
+        weight = float(self.user_weights.get(sub, 1.0))
+        with self._transaction() as conn:
+            virtual_time = conn.execute("SELECT virtual_time FROM clock WHERE id = 1").fetchone()[0]
+            row = conn.execute("SELECT last_finish_tag FROM users WHERE sub = ?", (sub,)).fetchone()
+            start_tag = max(virtual_time, row[0] if row else 0.0)
+            finish_tag = start_tag + cost / weight
+            conn.execute("INSERT OR REPLACE INTO users (sub, last_finish_tag) VALUES (?, ?)", (sub, finish_tag))
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, sub, cost, priority, state, start_tag, finish_tag, enqueued_at, heartbeat_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, sub, cost, 1 if priority else 0, start_tag, finish_tag, now, now),
+            )
+
+    def _expire_stale(self, conn, now):
+        # Jobs whose worker died without calling finish() stop heartbeating and are dropped.
+        expired = conn.execute("DELETE FROM jobs WHERE heartbeat_at < ?", (now - STALE_AFTER_SECONDS,)).rowcount
+        if expired and self.logger:
+            self.logger.warning(f"Scheduler dropped {expired} job(s) that stopped heartbeating.")
+
+    def _has_capacity(self, conn, job):
+        running = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running'").fetchone()[0]
+        return running < self.max_running
+
+    def try_start(self, job_id):
+        """
+        Starts `job_id` if it is the next eligible job and there is capacity.
+        Returns (started, status) where status holds queue position and ETA.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire_stale(conn, now)
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?", (now, job_id))
+            job = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if job is None:
+                raise LookupError(f"Job {job_id} is not queued.")
+            if job['state'] == 'running':
+                return True, None
+
+            running_by_user = dict(conn.execute("SELECT sub, COUNT(*) FROM jobs WHERE state = 'running' GROUP BY sub").fetchall())
+            queued = conn.execute("SELECT job_id, sub, cost FROM jobs WHERE state = 'queued' ORDER BY priority DESC, finish_tag, enqueued_at").fetchall()
+            # The next job to start is the first one whose owner is under the per-user limit.
+            next_job = next((q['job_id'] for q in queued if running_by_user.get(q['sub'], 0) < self.per_user_limit), None)
+            if next_job == job_id and self._has_capacity(conn, job):
+                conn.execute("UPDATE jobs SET state = 'running', started_at = ? WHERE job_id = ?", (now, job_id))
+                conn.execute("UPDATE clock SET virtual_time = MAX(virtual_time, ?) WHERE id = 1", (job['start_tag'],))
+                return True, None
+            return False, self._queue_status(conn, job_id, queued, running_by_user)
+
+    def _queue_status(self, conn, job_id, queued, running_by_user):
+        bytes_per_second = conn.execute("SELECT bytes_per_second FROM clock WHERE id = 1").fetchone()[0]
+        running = conn.execute("SELECT cost, started_at FROM jobs WHERE state = 'running'").fetchall()
+        now = time.time()
+        # Work still ahead: what is left of running jobs plus every queued job in front of this one.
+        ahead_bytes = sum(max(0.0, r['cost'] - (now - r['started_at']) * bytes_per_second) for r in running)
+        position = 0
+        for q in queued:
+            if q['job_id'] == job_id:
+                break
+            position += 1
+            ahead_bytes += q['cost']
+        parallelism = max(1, self.max_running)
+        # Rounded so the estimate does not produce a new progress event on every poll.
+        eta = ETA_GRANULARITY_SECONDS * round(ahead_bytes / (bytes_per_second * parallelism) / ETA_GRANULARITY_SECONDS)
+        return {
+            'position': position + 1,
+            'queued': len(queued),
+            'running': len(running),
+            'user_running': running_by_user.get(next((q['sub'] for q in queued if q['job_id'] == job_id), None), 0),
+            'estimated_start_seconds': eta,
+        }
+
+    def heartbeat(self, job_id):
+        """Marks a job as alive; rate-limited so it can be called on every progress item."""
+        now = time.time()
+        if now - self._last_heartbeat.get(job_id, 0) < HEARTBEAT_INTERVAL:
+            return
+        self._last_heartbeat[job_id] = now
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?", (now, job_id))
+
+    def finish(self, job_id):
+        """Removes a job and folds its observed throughput into the ETA estimate."""
+        self._last_heartbeat.pop(job_id, None)
+        now = time.time()
+        with self._transaction() as conn:
+            job = conn.execute("SELECT cost, started_at FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            if job is not None and job['started_at'] is not None and now - job['started_at'] > 0.5:
+                observed = job['cost'] / (now - job['started_at'])
+                conn.execute("UPDATE clock SET bytes_per_second = 0.8 * bytes_per_second + 0.2 * ? WHERE id = 1", (observed,))
+
+    def wait_for_turn(self, job_id, poll_interval=0.5):
+        """
+        Generator that blocks (cooperatively) until `job_id` may start,
+        yielding a status dict whenever its queue position or ETA changes.
+        """
+        last_status = None
+        while True:
+            started, status = self.try_start(job_id)
+            if started:
+                return
+            if status != last_status:
+                last_status = status
+                yield status
+            else:
+                yield None
+            time.sleep(poll_interval)
@@ -0,0 +1,358 @@
+# stream_pipeline.py
+# --- Processes a package while it is still being uploaded ---
+
+import os
+import time
+import zlib
+import struct
+import zipfile
+
+from werkzeug.sansio.multipart import MultipartDecoder, NEED_DATA, Field, File, Data, Epilogue
+
+from archive_writer import DATA_DESCRIPTOR_FLAG, DATA_DESCRIPTOR_SIGNATURE
+from progress import ProgressUpdate, PROGRESS_UPDATE_INTERVAL
+
+READ_SIZE = 64 * 1024
+PROGRESS_INTERVAL = 1024 * 1024
+# Caps the inflated output per call, so a highly compressible entry cannot balloon memory.
+INFLATE_LIMIT = 1024 * 1024
+
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+END_OF_CENTRAL_DIR_SIGNATURE = b'PK\x05\x06'
+ENCRYPTED_FLAG = 0x01
+UTF8_FLAG = 0x800
+ZIP64_EXTRA_ID = 0x0001
+_LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+
+
+class NotStreamable(Exception):
+    """The package can't be processed as it arrives; the job falls back to the regular path."""
+
+
+class PipelinedUpload:
+    """
+    Incremental reader for a multipart/form-data request body. The form fields
+    and the logo are read up front; the 'file' part must be the last part, and
+    its bytes are handed out as they arrive while being saved to disk.
+    """
+
+    def __init__(self, stream, boundary, content_length=None):
+        if not boundary:
+            raise ValueError("Missing multipart boundary.")
+        self.stream = stream
+        self.content_length = content_length
+        self.fields = {}
+        self.files = {}
+        self.bytes_received = 0
+        self._decoder = MultipartDecoder(boundary.encode('latin-1'))
+        self._eof = False
+
+    def _next_event(self):
+        while True:
+            try:
+                event = self._decoder.next_event()
+            except ValueError:
+                if self._eof:
+                    raise ValueError("The upload ended before it was complete.")
+                raise
+            if event is not NEED_DATA:
+                return event
+            if self._eof:
+                raise ValueError("The upload ended before it was complete.")
+            chunk = self.stream.read(READ_SIZE)
+            self.bytes_received += len(chunk)
+            if not chunk:
+                self._eof = True
+            self._decoder.receive_data(chunk or None)
+
+    def read_form(self):
+        """Reads every part before the package; returns the package's client-side filename."""
+        part, buffered = None, []
+        while True:
+            event = self._next_event()
+            if isinstance(event, File) and event.name == 'file':
+                return event.filename
+            if isinstance(event, (Field, File)):
+                part, buffered = event, []
+            elif isinstance(event, Data) and part is not None:
+                buffered.append(event.data)
+                if not event.more_data:
+                    value = b''.join(buffered)
+                    if isinstance(part, File):
+                        if part.filename:
+                            self.files[part.name] = (part.filename, value)
+                    else:
+                        self.fields[part.name] = value.decode('utf-8', 'replace')
+                    part = None
+            elif isinstance(event, Epilogue):
+                raise ValueError("No file part")
+
+    def iter_file(self, upload_path):
+        """Yields the package's bytes as they arrive, saving them to `upload_path`."""
+        with open(upload_path, 'wb') as f:
+            while True:
+                event = self._next_event()
+                if event.data:
+                    f.write(event.data)
+                    yield event.data
+                if not event.more_data:
+                    break
+        # Anything after the package would arrive too late to apply.
+        if not isinstance(self._next_event(), Epilogue):
+            raise ValueError("In a pipelined upload the 'file' part must be the last part of the form.")
+
+
+class _ChunkReader:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self.bytes_read = 0
+
+    def read(self, n):
+        """Up to `n` bytes; b'' only at the end of the input."""
+        if not self._buffer:
+            self._buffer = next(self._chunks, b'')
+            self.bytes_read += len(self._buffer)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def read_exact(self, n):
+        parts = []
+        while n:
+            data = self.read(n)
+            if not data:
+                raise NotStreamable("the upload ended in the middle of an entry")
+            parts.append(data)
+            n -= len(data)
+        return b''.join(parts)
+
+    def unread(self, data):
+        self._buffer = data + self._buffer
+
+    def drain(self):
+        """Consumes the rest of the input (the central directory)."""
+        self._buffer = b''
+        for chunk in self._chunks:
+            self.bytes_read += len(chunk)
+
+
+class LocalEntry:
+    """One entry as described by its local header; `iter_data` must be exhausted before the next."""
+
+    def __init__(self, reader, flags, method, dos_time, dos_date, crc, compress_size, file_size, name):
+        self._reader = reader
+        self.flags = flags
+        self.method = method
+        self.date_time = ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xF, dos_date & 0x1F,
+                          dos_time >> 11, (dos_time >> 5) & 0x3F, (dos_time & 0x1F) * 2)
+        self.crc = crc
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.name = name
+        self.has_descriptor = bool(flags & DATA_DESCRIPTOR_FLAG)
+        self.is_dir = name.endswith('/')
+        self.consumed = False
+
+    def iter_data(self):
+        """
+        Yields (raw, plain) pairs: bytes as stored in the upload and inflated
+        bytes, either of which may be empty. Checks the CRC and sizes at the
+        end, taking them from the data descriptor if the entry has one.
+        """
+        inflater = zlib.decompressobj(-15) if self.method == zipfile.ZIP_DEFLATED else None
+        crc = plain_size = raw_size = 0
+        while True:
+            if self.has_descriptor:
+                # Only deflated entries get here: the end of their stream marks the end of the data.
+                if inflater.eof:
+                    break
+                want = READ_SIZE
+            else:
+                want = min(READ_SIZE, self.compress_size - raw_size)
+                if not want:
+                    break
+            raw = self._reader.read(want)
+            if not raw:
+                raise NotStreamable(f"'{self.name}' is truncated")
+            if inflater is None:
+                crc = zlib.crc32(raw, crc)
+                plain_size += len(raw)
+                raw_size += len(raw)
+                yield raw, raw
+                continue
+            pending = raw
+            while pending and not inflater.eof:
+                plain = inflater.decompress(pending, INFLATE_LIMIT)
+                pending = inflater.unconsumed_tail
+                crc = zlib.crc32(plain, crc)
+                plain_size += len(plain)
+                yield b'', plain
+            if inflater.eof and inflater.unused_data:
+                if not self.has_descriptor:
+                    raise NotStreamable(f"'{self.name}' is shorter than its header says")
+                # The deflate stream ended inside this chunk; the rest belongs to the next record.
+                self._reader.unread(inflater.unused_data)
+                raw = raw[:len(raw) - len(inflater.unused_data)]
+            raw_size += len(raw)
+            yield raw, b''
+        if inflater is not None and not inflater.eof:
+            # Output zlib held back when the last input hit INFLATE_LIMIT.
+            plain = inflater.flush()
+            crc = zlib.crc32(plain, crc)
+            plain_size += len(plain)
+            yield b'', plain
+        self._finish(crc, plain_size, raw_size, inflater)
+
+    def _finish(self, crc, plain_size, raw_size, inflater):
+        if inflater is not None and not inflater.eof:
+            raise NotStreamable(f"'{self.name}' has an incomplete deflate stream")
+        if self.has_descriptor:
+            head = self._reader.read_exact(4)
+            if head == DATA_DESCRIPTOR_SIGNATURE:
+                head = self._reader.read_exact(4)
+            self.crc = struct.unpack('<L', head)[0]
+            self.compress_size, self.file_size = struct.unpack('<LL', self._reader.read_exact(8))
+        if crc != self.crc or plain_size != self.file_size or raw_size != self.compress_size:
+            raise NotStreamable(f"'{self.name}' does not match its CRC or size")
+        self.consumed = True
+
+
+def _has_zip64_extra(extra):
+    while len(extra) >= 4:
+        field_id, size = struct.unpack('<HH', extra[:4])
+        if field_id == ZIP64_EXTRA_ID:
+            return True
+        extra = extra[4 + size:]
+    return False
+
+
+def _iter_local_entries(reader):
+    """Yields a LocalEntry per local header, up to the start of the central directory."""
+    while True:
+        signature = reader.read_exact(4)
+        if signature in (CENTRAL_HEADER_SIGNATURE, END_OF_CENTRAL_DIR_SIGNATURE):
+            return
+        if signature != LOCAL_HEADER_SIGNATURE:
+            # Self-extractors, prefixed or spanned archives: only the central directory can be trusted.
+            raise NotStreamable("unexpected data where a zip entry should start")
+        (_, _, flags, method, dos_time, dos_date, crc, compress_size, file_size,
+         name_len, extra_len) = _LOCAL_HEADER.unpack(signature + reader.read_exact(_LOCAL_HEADER.size - 4))
+        raw_name = reader.read_exact(name_len)
+        extra = reader.read_exact(extra_len)
+        if flags & ENCRYPTED_FLAG:
+            raise NotStreamable("the package contains encrypted entries")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise NotStreamable(f"compression method {method} is not supported")
+        if _has_zip64_extra(extra) or 0xFFFFFFFF in (compress_size, file_size):
+            raise NotStreamable("the package contains Zip64 entries")
+        if flags & DATA_DESCRIPTOR_FLAG and method != zipfile.ZIP_DEFLATED:
+            # A stored entry of unknown size has no reliable end.
+            raise NotStreamable("the package contains stored entries with trailing sizes")
+        name = raw_name.decode('utf-8' if flags & UTF8_FLAG else 'cp437')
+        entry = LocalEntry(reader, flags, method, dos_time, dos_date, crc, compress_size, file_size, name)
+        yield entry
+        if not entry.consumed:
+            for _ in entry.iter_data():
+                pass
+
+
+def _check_name(name):
+    parts = name.rstrip('/').split('/')
+    if name.startswith('/') or '\\' in name or ':' in parts[0] or any(p in ('', '.', '..') for p in parts):
+        # zipfile's extractor rewrites such names; leave them to the regular path.
+        raise NotStreamable(f"'{name}' is not a plain relative path")
+
+
+def iter_stream_package(chunks, work_dir, archive, is_rewrite_target, removed_path):
+    """
+    Processes a zip as its bytes arrive. Entries are handled in the order of
+    their local headers: ones `removed_path` names are dropped, rewrite targets
+    are extracted to `work_dir` for the regular steps, and everything else is
+    copied into `archive` without recompression. Directories are created in
+    `work_dir` so the final pass adds the same directory entries as a full
+    extraction would.
+
+    Yields log lines and ProgressUpdates (bytes of the upload consumed, at
+    least every PROGRESS_INTERVAL bytes or PROGRESS_UPDATE_INTERVAL seconds,
+    so a slow upload still keeps the job's heartbeats going) and returns {name: (crc, size)} for every entry seen, for
+    verify_central_directory. Raises NotStreamable as soon as something needs
+    the central directory.
+    """
+    reader = _ChunkReader(chunks)
+    entries = {}
+    reported = set()
+    progress, progress_at = 0, time.monotonic()
+    for entry in _iter_local_entries(reader):
+        name = entry.name
+        _check_name(name)
+        if name in entries:
+            raise NotStreamable(f"'{name}' appears more than once")
+        removed = removed_path(name)
+        if removed and removed not in reported:
+            reported.add(removed)
+            yield f"  -> Removed {'directory' if removed.endswith('/') else 'file'}: {removed.rstrip('/')}"
+        if not removed or removed == name and not entry.is_dir:
+            target_dir = name if entry.is_dir else os.path.dirname(name)
+            if target_dir:
+                os.makedirs(os.path.join(work_dir, target_dir), exist_ok=True)
+
+        if removed or entry.is_dir:
+            data = entry.iter_data()
+        elif is_rewrite_target(name):
+            data = _extract(entry, os.path.join(work_dir, name))
+        else:
+            data = _copy(entry, archive)
+        for _ in data:
+            if reader.bytes_read - progress >= PROGRESS_INTERVAL or time.monotonic() - progress_at >= PROGRESS_UPDATE_INTERVAL:
+                yield ProgressUpdate(reader.bytes_read - progress)
+                progress, progress_at = reader.bytes_read, time.monotonic()
+        entries[name] = (entry.crc, entry.file_size)
+    reader.drain()
+    yield ProgressUpdate(reader.bytes_read - progress)
+    return entries
+
+
+def _extract(entry, path):
+    with open(path, 'wb') as f:
+        for raw, plain in entry.iter_data():
+            f.write(plain)
+            yield
+
+
+def _copy(entry, archive):
+    zinfo = zipfile.ZipInfo(entry.name, entry.date_time)
+    zinfo.compress_type = entry.method
+    zinfo.external_attr = 0o100644 << 16
+    if entry.has_descriptor:
+        zinfo.flag_bits |= DATA_DESCRIPTOR_FLAG
+    else:
+        zinfo.CRC, zinfo.compress_size, zinfo.file_size = entry.crc, entry.compress_size, entry.file_size
+    archive.begin_raw_entry(zinfo)
+    for raw, plain in entry.iter_data():
+        if raw:
+            archive.write_raw(raw)
+        yield
+    zinfo.CRC, zinfo.compress_size, zinfo.file_size = entry.crc, entry.compress_size, entry.file_size
+    archive.end_raw_entry(zinfo)
+
+
+def verify_central_directory(zip_path, entries):
+    """
+    Checks the saved upload's central directory against the local headers that
+    were streamed. They can disagree (entries the directory leaves out or
+    replaces, appended updates), and the directory is what an unzip honours.
+    Returns its infolist.
+    """
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            infos = zf.infolist()
+    except (zipfile.BadZipFile, OSError) as e:
+        raise NotStreamable(f"the central directory can't be read ({e})")
+    if len(infos) != len(entries):
+        raise NotStreamable(f"the central directory lists {len(infos)} entries, the upload contained {len(entries)}")
+    for info in infos:
+        seen = entries.get(info.filename)
+        if seen is None or seen != (info.CRC, info.file_size):
+            raise NotStreamable(f"the central directory disagrees with the local header of '{info.filename}'")
+    return infos
@@ -0,0 +1,37 @@
+# tests/conftest.py
+# --- Shared fixtures: the app is imported once, inside a scratch working directory ---
+
+import importlib
+import os
+import shutil
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """app.py, built in a temporary directory so its relative folders (uploads, processed, jobs...) land there."""
+    workdir = tmp_path_factory.mktemp('workdir')
+    shutil.copytree(os.path.join(REPO_ROOT, 'special_files'), workdir / 'special_files')
+    os.environ.setdefault('AUTH0_DOMAIN', 'tests.invalid')
+    os.environ.setdefault('API_AUDIENCE', 'tests')
+    os.environ.setdefault('PRELOAD_OPTIONAL_MODULES', 'false')
+    # Absolute, so the analytics and scheduler databases still resolve after the cwd is restored.
+    os.environ.setdefault('JOBS_FOLDER', str(workdir / 'jobs'))
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        yield importlib.import_module('app')
+    finally:
+        os.chdir(previous_cwd)
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    """A test client whose bearer tokens are accepted without a JWKS lookup."""
+    monkeypatch.setattr(app_module, 'decode_auth_header', lambda auth: {'sub': 'tests', 'scope': ''})
+    return app_module.app.test_client()
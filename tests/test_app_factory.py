@@ -0,0 +1,17 @@
+# tests/test_app_factory.py
+# --- create_app() builds independent apps: handlers use current_app, logging is set up once ---
+
+
+def test_second_app_uses_its_own_config_without_duplicate_log_handlers(app_module, monkeypatch, tmp_path):
+    handlers_before = list(app_module.app.logger.handlers)
+    second = app_module.create_app()
+    assert second is not app_module.app
+    assert second.logger.handlers == handlers_before
+
+    second.config['PROCESSED_FOLDER'] = str(tmp_path)
+    (tmp_path / 'only_here.zip').write_bytes(b'PK\x05\x06' + b'\x00' * 18)
+    monkeypatch.setattr(app_module, 'decode_auth_header', lambda auth: {'sub': 'tests', 'scope': ''})
+    headers = {'Authorization': 'Bearer test'}
+
+    assert second.test_client().get('/download/only_here.zip', headers=headers).status_code == 200
+    assert app_module.app.test_client().get('/download/only_here.zip', headers=headers).status_code == 404
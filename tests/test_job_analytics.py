@@ -0,0 +1,67 @@
+# tests/test_job_analytics.py
+# --- Per-job memory figures used to predict a job's cost ---
+
+import sqlite3
+import time
+import zipfile
+
+import job_analytics
+from concurrency_controller import MIN_HISTORY_SAMPLES, predict_job_resources
+from job_analytics import JobAnalytics, JobMemoryTracker
+
+
+def test_memory_growth_is_measured_from_the_jobs_own_start(monkeypatch):
+    rss = iter([500, 520, 900])
+    monkeypatch.setattr(job_analytics, 'current_rss_bytes', lambda: next(rss))
+    tracker = JobMemoryTracker(sample_interval=0)
+    tracker.start()
+    tracker.sample()
+
+    # A worker already holding 500 bytes is not charged to the job.
+    assert tracker.finish() == 400
+
+
+def test_overlapping_jobs_in_one_worker_record_no_growth(monkeypatch):
+    monkeypatch.setattr(job_analytics, 'current_rss_bytes', lambda: 100)
+    first, second, later = JobMemoryTracker(), JobMemoryTracker(), JobMemoryTracker()
+    first.start()
+    second.start()
+    assert second.finish() is None
+    assert first.finish() is None
+    # Once both are gone, a job running alone is measured again.
+    later.start()
+    assert later.finish() == 0
+
+
+def test_prediction_uses_recorded_growth(tmp_path):
+    package = tmp_path / 'package.zip'
+    with zipfile.ZipFile(package, 'w') as zf:
+        zf.writestr('index.html', 'x' * 1000)
+    analytics = JobAnalytics(str(tmp_path / 'analytics.db'))
+    now = time.time()
+    for i in range(MIN_HISTORY_SAMPLES):
+        analytics.record({'job_id': f'j{i}', 'attempt_started_at': now, 'finished_at': now, 'outcome': 'done', 'resumed': False,
+                          'engine_type': 'iengine6', 'uncompressed_bytes': 1000, 'duration_s': 1.0,
+                          'rss_growth_bytes': 300 * 1024 * 1024})
+    # Runs that overlapped another job don't count towards the history.
+    analytics.record({'job_id': 'shared', 'attempt_started_at': now, 'finished_at': now, 'outcome': 'done', 'resumed': False,
+                      'engine_type': 'iengine6', 'uncompressed_bytes': 1000, 'duration_s': 1.0, 'rss_growth_bytes': None})
+    analytics.flush()
+    # The background writer may still hold the last batch.
+    deadline = time.monotonic() + 5
+    while len(analytics.similar_runs(1000, 'iengine6')['duration_s']) < MIN_HISTORY_SAMPLES + 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert len(analytics.similar_runs(1000, 'iengine6')['rss_growth_bytes']) == MIN_HISTORY_SAMPLES
+    assert predict_job_resources(str(package), analytics).memory_bytes == 300 * 1024 * 1024
+
+
+def test_database_from_before_growth_tracking_is_upgraded(tmp_path):
+    db_path = str(tmp_path / 'analytics.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute(job_analytics._SCHEMA.split(';')[0].replace('rss_growth_bytes', 'peak_rss_bytes'))
+    conn.close()
+
+    analytics = JobAnalytics(db_path)
+
+    assert analytics.similar_runs(1000) == {'rss_growth_bytes': [], 'duration_s': []}
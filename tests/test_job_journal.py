@@ -0,0 +1,63 @@
+# tests/test_job_journal.py
+# --- Following a job's progress from its journal ---
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import job_journal
+from job_journal import JobJournal
+
+
+def test_streams_on_one_job_share_a_tailer_that_polls_off_the_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_journal, 'MAX_POLL_INTERVAL', 0.05)
+    writer = JobJournal.create(str(tmp_path), 'job1', 'tests', {})
+    assert writer.acquire()
+    polls = []
+    poll_frames = JobJournal._poll_frames
+
+    def counting_poll(self, offset, last_seq):
+        polls.append(threading.current_thread().name)
+        return poll_frames(self, offset, last_seq)
+    monkeypatch.setattr(JobJournal, '_poll_frames', counting_poll)
+    tailers = []
+    tailer_init = job_journal._JobTailer.__init__
+
+    def counting_init(self, *args):
+        tailers.append(self)
+        tailer_init(self, *args)
+    monkeypatch.setattr(job_journal._JobTailer, '__init__', counting_init)
+
+    async def collect(journal, last_seq):
+        return [frame async for frame in journal.afollow(last_seq, poll_interval=0.01, executor=executor)]
+
+    async def main():
+        streams = asyncio.gather(
+            collect(JobJournal.load(str(tmp_path), 'job1'), 0),
+            collect(JobJournal.load(str(tmp_path), 'job1'), 1),
+        )
+        for seq in (1, 2, 3):
+            await asyncio.sleep(0.03)
+            writer.record(seq, f'frame {seq}')
+        writer.finish('done')
+        return await streams
+
+    with ThreadPoolExecutor(thread_name_prefix='journal-io') as executor:
+        first, second = asyncio.run(main())
+
+    assert first == ['frame 1', 'frame 2', 'frame 3']
+    assert second == ['frame 2', 'frame 3']
+    assert polls and all(name.startswith('journal-io') for name in polls)
+    assert len(tailers) == 1
+    assert not job_journal._JobTailer._by_job
+
+
+def test_stream_ends_when_the_runner_is_gone(tmp_path):
+    JobJournal.create(str(tmp_path), 'job2', 'tests', {})
+    follower = JobJournal.load(str(tmp_path), 'job2')
+
+    async def main():
+        return [frame async for frame in follower.afollow(0, poll_interval=0.01)]
+
+    # Nobody holds the run lock, so the client is told to reconnect and resume it.
+    assert asyncio.run(main()) == []
@@ -0,0 +1,119 @@
+# tests/test_job_resume.py
+# --- A job whose worker died mid-step resumes from its journal with an intact working copy ---
+
+import builtins
+import io
+import json
+import os
+import zipfile
+import xml.etree.ElementTree as ET
+
+import pytest
+
+MANIFEST = (
+    '<?xml version="1.0"?>'
+    '<manifest identifier="m" xmlns="http://www.imsglobal.org/xsd/imscp_v1p1">'
+    '<organizations default="o"><organization identifier="o"><item identifier="i1" identifierref="r1"><title>T</title></item></organization></organizations>'
+    '<resources><resource identifier="r1" type="webcontent" href="index.html"><file href="index.html"/></resource></resources>'
+    '</manifest>'
+)
+PACKAGE_FILES = {
+    'imsmanifest.xml': MANIFEST,
+    'imsmanifest_SCORM2004.xml': MANIFEST,
+    'index.html': '<html></html>',
+    'js/scorm_2004.js': 'function commit() { LMSCommit(); }\n' * 200,
+    'xmls/adminsettings.xml': '<?xml version="1.0"?><settings><UseScorm>false</UseScorm><ReviewMode>true</ReviewMode>' + '<Pad/>' * 500 + '</settings>',
+}
+
+
+class WorkerKilled(BaseException):
+    """Stands in for SIGKILL: nothing in the job catches it."""
+
+
+def make_package():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, text in PACKAGE_FILES.items():
+            zf.writestr(name, text)
+    return buffer.getvalue()
+
+
+def kill_while_writing(app_module, monkeypatch, basename):
+    """Makes the first edit of `basename` (after its extraction) stop halfway through a write and kill the job."""
+    opened = []
+
+    def open_then_die(path, mode='r', *args, **kwargs):
+        f = builtins.open(path, mode, *args, **kwargs)
+        if not set(mode) & set('wa+') or not os.path.basename(path).startswith(basename):
+            return f
+        opened.append(path)
+        if len(opened) == 1:
+            return f
+        monkeypatch.delattr(app_module, 'open')
+        write = f.write
+
+        def write_half_then_die(data):
+            write(data[:len(data) // 2])
+            f.flush()
+            raise WorkerKilled()
+        f.write = write_half_then_die
+        return f
+    monkeypatch.setattr(app_module, 'open', open_then_die, raising=False)
+
+
+def events(body):
+    parsed = []
+    for frame in body.split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in frame.splitlines() if ': ' in line)
+        if 'event' in lines:
+            parsed.append((int(lines['id']), lines['event'], json.loads(lines['data'])))
+    return parsed
+
+
+def completed_steps(app_module, job_id):
+    with open(os.path.join(app_module.app.config['JOBS_FOLDER'], job_id, 'journal.jsonl')) as f:
+        return [record['name'] for record in map(json.loads, f) if record['type'] == 'step']
+
+
+@pytest.mark.parametrize('arcname, step', [
+    ('xmls/adminsettings.xml', 'admin_settings'),
+    ('js/scorm_2004.js', 'js_2004'),
+])
+def test_job_killed_mid_write_resumes_through_events(app_module, client, monkeypatch, arcname, step):
+    headers = {'Authorization': 'Bearer test'}
+    filename = f"resume_{step}.zip"
+    kill_while_writing(app_module, monkeypatch, os.path.basename(arcname))
+    response = client.post('/api/process', headers=headers, content_type='multipart/form-data', buffered=False, data={
+        'scorm_type': '2004',
+        'is_licensed': 'true',
+        'is_scorm_enabled': 'true',
+        'file': (io.BytesIO(make_package()), filename),
+    })
+    job_id = response.headers['X-Job-Id']
+    received = []
+    with pytest.raises(WorkerKilled):
+        for chunk in response.response:
+            received.append(chunk.decode() if isinstance(chunk, bytes) else chunk)
+    response.close()
+    assert step not in completed_steps(app_module, job_id)
+    # The interrupted edit left the working copy's file as it was.
+    with open(os.path.join(app_module.app.config['JOBS_FOLDER'], job_id, 'work', arcname), encoding='utf-8') as f:
+        assert f.read() == PACKAGE_FILES[arcname]
+
+    last_seq = events(''.join(received))[-1][0]
+    resumed = client.get(f'/api/jobs/{job_id}/events', headers=dict(headers, **{'Last-Event-ID': str(last_seq)}))
+    body = resumed.get_data(as_text=True)
+    assert 'Resuming interrupted job' in body
+    assert [e for _, e, _ in events(body)][-1] == 'done', body[-500:]
+    # Numbering carries on from the frames the client already has.
+    assert events(body)[0][0] == last_seq + 1
+
+    with zipfile.ZipFile(os.path.join('processed', filename.replace('.zip', '_processed_2004.zip'))) as zf:
+        assert zf.testzip() is None
+        assert not any(name.endswith('.tmp') for name in zf.namelist())
+        settings = ET.fromstring(zf.read('xmls/adminsettings.xml'))
+        assert settings.find('UseScorm').text == 'true'
+        assert settings.find('ReviewMode').text == 'false'
+        assert len(settings.findall('Pad')) == 500
+        script = zf.read('js/scorm_2004.js').decode()
+        assert script == PACKAGE_FILES['js/scorm_2004.js'].replace('LMSCommit()', 'SCORM2004_CallCommit()')
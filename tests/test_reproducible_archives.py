@@ -0,0 +1,77 @@
+# tests/test_reproducible_archives.py
+# --- The same package and options must give byte-identical output, cold or warm blob cache ---
+
+import hashlib
+import io
+import os
+import zipfile
+
+from blob_store import BlobStore
+
+MANIFEST = (
+    '<?xml version="1.0"?>'
+    '<manifest identifier="m" xmlns="http://www.imsglobal.org/xsd/imscp_v1p1">'
+    '<organizations default="o"><organization identifier="o"><item identifier="i1" identifierref="r1"><title>T</title></item></organization></organizations>'
+    '<resources><resource identifier="r1" type="webcontent" href="index.html"><file href="index.html"/></resource></resources>'
+    '</manifest>'
+)
+
+
+def make_package():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('imsmanifest.xml', MANIFEST)
+        zf.writestr('imsmanifest_SCORM2004.xml', MANIFEST)
+        zf.writestr('index.html', '<html></html>')
+        zf.writestr('js/scorm_2004.js', 'function commit() { LMSCommit(); }\n' * 200)
+        # Large enough for the blob store to take them.
+        for i in range(5):
+            zf.writestr(f'js/lib{i}.js', f'// lib {i}\n' + 'var value = 1;\n' * 2000)
+        zf.writestr('xmls/adminsettings.xml', '<?xml version="1.0"?><settings><UseScorm>false</UseScorm><TopLogo/></settings>')
+        zf.writestr('media/notes.txt', 'notes')
+    return buf.getvalue()
+
+
+def process(client, package, headers=None):
+    response = client.post('/api/process', headers={'Authorization': 'Bearer test', **(headers or {})}, content_type='multipart/form-data', data={
+        'scorm_type': '2004',
+        'is_licensed': 'true',
+        'is_scorm_enabled': 'true',
+        # Last, as pipelined uploads require.
+        'file': (io.BytesIO(package), 'course.zip'),
+    })
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert 'event: done' in body, body[-500:]
+    with open(os.path.join('processed', 'course_processed_2004.zip'), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_regular_path_is_reproducible_with_a_warm_blob_cache(app_module, client, monkeypatch, tmp_path):
+    app = app_module.app
+    monkeypatch.setitem(app.config, 'DETERMINISTIC_ARCHIVES', True)
+    # Admit on first sight, so the second and later runs splice cached entries in.
+    blob_store = BlobStore(str(tmp_path / 'blobs'), min_hits=1, logger=app.logger)
+    monkeypatch.setitem(app.extensions, 'blob_store', blob_store)
+
+    package = make_package()
+    digests = [process(client, package) for _ in range(3)]
+
+    assert blob_store.snapshot().get('hits', 0) > 0
+    assert len(set(digests)) == 1
+    # The digest behind ETag / Repr-Digest is the archive's own.
+    with open(os.path.join('processed', 'course_processed_2004.zip.sha256'), encoding='utf-8') as f:
+        assert f.read().split()[0] == digests[0]
+
+
+def test_pipelined_request_falls_back_to_the_regular_path_in_deterministic_mode(app_module, client, monkeypatch):
+    """Not a test of pipelining itself: a deterministic job must not take that path, even when asked to."""
+    app = app_module.app
+    monkeypatch.setitem(app.config, 'DETERMINISTIC_ARCHIVES', True)
+    monkeypatch.setitem(app.config, 'PIPELINED_UPLOADS', True)
+
+    package = make_package()
+    regular = process(client, package)
+    pipelined = process(client, package, headers={'X-Upload-Mode': 'pipelined'})
+
+    assert pipelined == regular
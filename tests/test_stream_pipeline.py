@@ -0,0 +1,198 @@
+# tests/test_stream_pipeline.py
+# --- Pipelined uploads: packages processed as they arrive must match the regular path ---
+
+import io
+import json
+import os
+import struct
+import zipfile
+
+import pytest
+
+MANIFEST = (
+    '<?xml version="1.0"?>'
+    '<manifest identifier="m" xmlns="http://www.imsglobal.org/xsd/imscp_v1p1">'
+    '<organizations default="o"><organization identifier="o"><item identifier="i1" identifierref="r1"><title>T</title></item></organization></organizations>'
+    '<resources><resource identifier="r1" type="webcontent" href="index.html"><file href="index.html"/></resource></resources>'
+    '</manifest>'
+)
+PACKAGE_FILES = {
+    'imsmanifest.xml': MANIFEST,
+    'imsmanifest_SCORM2004.xml': MANIFEST,
+    'index.html': '<html></html>',
+    'js/scorm_2004.js': 'function commit() { LMSCommit(); }\n' * 200,
+    'js/lib.js': 'var value = 1;\n' * 5000,
+    'xmls/adminsettings.xml': '<?xml version="1.0"?><settings><UseScorm>false</UseScorm><TopLogo/></settings>',
+    'media/notes.txt': 'notes',
+    'README.md': 'readme',
+    '.idea/workspace.xml': '<project/>',
+}
+
+
+class NonSeekable(io.RawIOBase):
+    """Makes ZipFile write data descriptors, as streaming zip tools do."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def make_package(compression=zipfile.ZIP_DEFLATED, descriptors=False, extra_files=None):
+    target = NonSeekable() if descriptors else io.BytesIO()
+    with zipfile.ZipFile(target, 'w', compression) as zf:
+        for name, text in {**PACKAGE_FILES, **(extra_files or {})}.items():
+            zf.writestr(name, text)
+    return (target.buffer if descriptors else target).getvalue()
+
+
+def drop_from_central_directory(data, name):
+    """Removes `name` from the central directory only; its local header and data stay in place."""
+    eocd = data.rindex(b'PK\x05\x06')
+    cd_size, cd_offset = struct.unpack('<II', data[eocd + 12:eocd + 20])
+    records, pos = [], cd_offset
+    while pos < cd_offset + cd_size:
+        name_len, extra_len, comment_len = struct.unpack('<HHH', data[pos + 28:pos + 34])
+        end = pos + 46 + name_len + extra_len + comment_len
+        if data[pos + 46:pos + 46 + name_len].decode() != name:
+            records.append(data[pos:end])
+        pos = end
+    directory = b''.join(records)
+    eocd_record = data[eocd:eocd + 8] + struct.pack('<HHII', len(records), len(records), len(directory), cd_offset) + data[eocd + 20:]
+    return data[:cd_offset] + directory + eocd_record
+
+
+def process(client, package, filename, pipelined):
+    headers = {'Authorization': 'Bearer test'}
+    if pipelined:
+        headers['X-Upload-Mode'] = 'pipelined'
+    response = client.post('/api/process', headers=headers, content_type='multipart/form-data', data={
+        'scorm_type': '2004',
+        'is_licensed': 'true',
+        'is_scorm_enabled': 'true',
+        # Pipelined uploads need the package as the last part.
+        'file': (io.BytesIO(package), filename),
+    })
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert 'event: done' in body, body[-500:]
+    return body
+
+
+def output_contents(filename):
+    path = os.path.join('processed', filename.replace('.zip', '_processed_2004.zip'))
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        return {info.filename: None if info.is_dir() else zf.read(info) for info in zf.infolist()}
+
+
+def streamed(body):
+    return 'as they arrived' in body
+
+
+def fell_back(body):
+    return "can't be processed as it uploads" in body
+
+
+@pytest.fixture
+def pipelined_app(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'DETERMINISTIC_ARCHIVES', False)
+    monkeypatch.setitem(app_module.app.config, 'PIPELINED_UPLOADS', True)
+    return app_module.app
+
+
+def test_deflated_entries_with_data_descriptors_are_streamed(pipelined_app, client):
+    package = make_package(descriptors=True)
+    regular = process(client, package, 'dd_regular.zip', pipelined=False)
+    body = process(client, package, 'dd_pipelined.zip', pipelined=True)
+
+    assert streamed(body) and not fell_back(body)
+    assert not streamed(regular)
+    assert output_contents('dd_pipelined.zip') == output_contents('dd_regular.zip')
+
+
+def test_plain_local_headers_are_streamed(pipelined_app, client):
+    package = make_package()
+    process(client, package, 'plain_regular.zip', pipelined=False)
+    body = process(client, package, 'plain_pipelined.zip', pipelined=True)
+
+    assert streamed(body)
+    assert output_contents('plain_pipelined.zip') == output_contents('plain_regular.zip')
+
+
+def test_stored_entry_with_a_data_descriptor_falls_back(pipelined_app, client):
+    # A stored entry's end can't be found without its size, which only the descriptor holds.
+    package = make_package(compression=zipfile.ZIP_STORED, descriptors=True)
+    process(client, package, 'sd_regular.zip', pipelined=False)
+    body = process(client, package, 'sd_pipelined.zip', pipelined=True)
+
+    assert fell_back(body)
+    assert output_contents('sd_pipelined.zip') == output_contents('sd_regular.zip')
+
+
+def test_central_directory_disagreeing_with_local_headers_falls_back(pipelined_app, client):
+    package = drop_from_central_directory(make_package(extra_files={'media/stray.txt': 'not in the directory'}), 'media/stray.txt')
+    with zipfile.ZipFile(io.BytesIO(package)) as zf:
+        assert 'media/stray.txt' not in zf.namelist()
+    process(client, package, 'cd_regular.zip', pipelined=False)
+    body = process(client, package, 'cd_pipelined.zip', pipelined=True)
+
+    assert fell_back(body)
+    assert 'central directory' in body
+    # The directory is what an unzip honours, so the stray entry must not reach the output.
+    contents = output_contents('cd_pipelined.zip')
+    assert 'media/stray.txt' not in contents
+    assert contents == output_contents('cd_regular.zip')
+
+
+def test_cleanup_entries_are_dropped_as_they_arrive(pipelined_app, client):
+    body = process(client, make_package(), 'clean_pipelined.zip', pipelined=True)
+
+    assert streamed(body)
+    assert 'Removed directory: .idea' in body and 'Removed file: README.md' in body
+    names = set(output_contents('clean_pipelined.zip'))
+    assert not any(name.startswith('.idea') for name in names)
+    assert 'README.md' not in names
+    assert 'media/notes.txt' in names
+
+
+@pytest.mark.parametrize('arcname, removed', [
+    ('.idea/', '.idea/'),
+    ('.idea/workspace.xml', '.idea/'),
+    ('sub/__MACOSX/._x', 'sub/__MACOSX/'),
+    ('README.md', 'README.md'),
+    ('docs/readme.md', 'docs/readme.md'),
+    ('aicc.crs', 'aicc.crs'),
+    ('js/lib.js', None),
+    ('idea/file.txt', None),
+])
+def test_pipeline_removed_path_matches_clean_unnecessary_files(app_module, arcname, removed):
+    assert app_module.pipeline_removed_path(arcname) == removed
+
+
+def progress_frames(body):
+    frames = []
+    for frame in body.split('\n\n'):
+        if 'event: progress' in frame:
+            data = next(line for line in frame.splitlines() if line.startswith('data: '))
+            frames.append(json.loads(data[len('data: '):]))
+    return frames
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_progress_never_overshoots_its_total(pipelined_app, client, monkeypatch, pipelined):
+    # Send a frame for every change, so each step's count is seen.
+    monkeypatch.setattr('progress.PERCENT_INTERVAL', 0)
+    body = process(client, make_package(), f'progress_{pipelined}.zip', pipelined=pipelined)
+
+    assert streamed(body) == pipelined
+    frames = [f for f in progress_frames(body) if 'bytes_total' in f]
+    assert frames
+    assert all(f['bytes'] <= f['bytes_total'] for f in frames), [(f['bytes'], f['bytes_total']) for f in frames]
+    # The re-zip step finishes exactly on its total.
+    last = frames[-1]
+    assert last['step_name'] == 'Re-zipping the package' and last['bytes'] == last['bytes_total']
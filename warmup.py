@@ -0,0 +1,63 @@
+# warmup.py
+# --- Startup warm-up hooks and time-to-first-request reporting ---
+
+import gc
+import os
+import time
+
+# Set when this module is first imported, i.e. as the (master) process boots.
+PROCESS_STARTED_AT = time.monotonic()
+_worker_started_at = PROCESS_STARTED_AT
+_first_request_seen = False
+
+
+def _mark_worker_start():
+    global _worker_started_at, _first_request_seen
+    _worker_started_at = time.monotonic()
+    _first_request_seen = False
+
+
+# Forked workers measure time-to-first-request from their own birth.
+os.register_at_fork(after_in_child=_mark_worker_start)
+
+
+def run_warmup_hooks(app, hooks):
+    """
+    Runs each `hook(app)` once, logging how long it took. With gunicorn's
+    --preload this happens in the master, so the results are inherited by
+    every worker through copy-on-write instead of being rebuilt per worker.
+    """
+    timings = {}
+    for hook in hooks:
+        started = time.monotonic()
+        try:
+            hook(app)
+        except Exception as e:
+            # A failed warm-up only costs latency later; it must not stop the app.
+            app.logger.warning(f"Warm-up hook '{hook.__name__}' failed: {e}")
+        timings[hook.__name__] = round((time.monotonic() - started) * 1000, 1)
+    app.logger.info(f"Warm-up hooks completed: {timings} (ms)")
+    return timings
+
+
+def freeze_heap():
+    """
+    Moves everything allocated so far out of the GC's reach, so collections in
+    forked workers do not write to (and un-share) the master's pages.
+    """
+    gc.collect()
+    gc.freeze()
+
+
+def report_startup(app):
+    app.logger.info(f"App ready {round((time.monotonic() - PROCESS_STARTED_AT) * 1000, 1)} ms after process start (pid {os.getpid()}).")
+
+
+def record_first_request(app):
+    """before_request hook: logs time-to-first-request once per worker."""
+    global _first_request_seen
+    if _first_request_seen:
+        return
+    _first_request_seen = True
+    elapsed = time.monotonic() - _worker_started_at
+    app.logger.info(f"Time to first request: {round(elapsed * 1000, 1)} ms after worker start (pid {os.getpid()}).")